@@ -57,7 +57,7 @@ async def fetch_all_terms(conn):
 async def add_course(conn, course_tuple):
     try:
         async with conn.cursor() as cur:
-            await cur.execute('INSERT OR IGNORE INTO courses VALUES (?, ?, ?)', course_tuple)
+            await cur.execute('INSERT OR IGNORE INTO courses (class_id, status, year_term, institution) VALUES (?, ?, ?, ?)', course_tuple)
             await conn.commit()
     except Exception as e:
         logger.error(f'DB error occurred while attempting to add course {course_tuple}: {e}')
@@ -66,7 +66,6 @@ async def add_course(conn, course_tuple):
 async def remove_course(conn, class_id):
     try:
         async with conn.cursor() as cur:
-            await cur.execute('PRAGMA foreign_keys=ON')
             await cur.execute('DELETE FROM courses WHERE class_id = ?', (class_id,))
             await conn.commit()
     except Exception as e:
@@ -106,6 +105,35 @@ async def fetch_all_courses(conn):
         return []
 
 
+async def update_course_statuses(conn, status_tuples):
+    try:
+        async with conn.cursor() as cur:
+            await cur.executemany("""
+                UPDATE courses
+                SET status = ?
+                WHERE class_id = ?
+            """, status_tuples)
+            await conn.commit()
+            return True
+    except Exception as e:
+        logger.error(f'DB error occurred while trying to update {len(status_tuples)} course statuses: {e}')
+        return False
+
+
+async def fetch_all_courses_with_names(conn):
+    try:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                SELECT courses.class_id, course_details.class_name, courses.status, courses.year_term, courses.institution
+                FROM courses
+                LEFT JOIN course_details ON courses.class_id = course_details.class_id
+            """)
+            return await cur.fetchall()
+    except Exception as e:
+        logger.error(f'DB error occurred while attempting to fetch all courses with names: {e}')
+        return []
+
+
 async def get_course_name_and_status(conn, class_id):
     try:
         async with conn.cursor() as cur:
@@ -125,7 +153,8 @@ async def get_course_with_term_info_row(conn, class_id):
     try:
         async with conn.cursor() as cur:
             await cur.execute('''
-                SELECT courses.*, term_info.hidden_value, term_info.term_id
+                SELECT courses.class_id, courses.status, courses.year_term, courses.institution,
+                    term_info.hidden_value, term_info.term_id
                 FROM courses
                 INNER JOIN term_info ON courses.year_term = term_info.year_term
                 WHERE courses.class_id = ?
@@ -140,7 +169,8 @@ async def get_course_with_details_row(conn, class_id):
     try:
         async with conn.cursor() as cur:
             await cur.execute("""
-                SELECT courses.*, course_details.class_name, course_details.times, course_details.professor
+                SELECT courses.class_id, courses.status, courses.year_term,
+                    course_details.class_name, course_details.times, course_details.professor
                 FROM courses
                 JOIN course_details ON courses.class_id = course_details.class_id
                 WHERE courses.class_id = ?
@@ -160,6 +190,20 @@ async def add_course_details(conn, course_details_tuple):
         logger.error(f'DB error occurred while trying to add course details {course_details_tuple}: {e}')
 
 
+async def add_courses_with_interests(conn, course_tuples, course_details_tuples, user_interests_tuples):
+    try:
+        async with conn.cursor() as cur:
+            await cur.executemany('INSERT OR IGNORE INTO courses (class_id, status, year_term, institution) VALUES (?, ?, ?, ?)', course_tuples)
+            await cur.executemany('INSERT OR IGNORE INTO course_details VALUES (?, ?, ?, ?)', course_details_tuples)
+            await cur.executemany('INSERT OR IGNORE INTO user_interests VALUES (?, ?, ?)', user_interests_tuples)
+            await conn.commit()
+            return True
+    except Exception as e:
+        await conn.rollback()
+        logger.error(f'DB error occurred while trying to add {len(course_tuples)} courses and {len(user_interests_tuples)} user interests: {e}')
+        return False
+
+
 async def get_course_details(conn, class_id):
     try:
         async with conn.cursor() as cur:
@@ -185,10 +229,9 @@ async def remove_user_interest(conn, user_id, class_id):
             await cur.execute('DELETE FROM user_interests WHERE user_id = ? AND class_id = ?', (user_id, class_id))
             num_deleted_user_interests = cur.rowcount
             
-            await cur.execute('SELECT COUNT(*) FROM user_interests WHERE class_id = ?', (class_id,))
+            await cur.execute('SELECT EXISTS (SELECT 1 FROM user_interests WHERE class_id = ?)', (class_id,))
             remaining_users_interested = await cur.fetchone()
-            if remaining_users_interested[0] == 0:
-                await cur.execute('PRAGMA foreign_keys=ON')
+            if not remaining_users_interested[0]:
                 await cur.execute('DELETE FROM courses WHERE class_id = ?', (class_id,))
                 num_deleted_user_interests *= -1 # A way to indicate that the whole course was deleted from DB.
             
@@ -218,3 +261,290 @@ async def fetch_user_interests(conn, user_id):
     except Exception as e:
         logger.error(f'DB error occurred while attempting to fetch all user interests: {e}')
         return []
+
+
+async def fetch_user_courses_with_details(conn, user_id):
+    try:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                SELECT courses.class_id, courses.status, courses.year_term,
+                    course_details.class_name, course_details.times, course_details.professor
+                FROM user_interests
+                JOIN courses ON user_interests.class_id = courses.class_id
+                JOIN course_details ON courses.class_id = course_details.class_id
+                WHERE user_interests.user_id = ?
+            """, (user_id,))
+            return await cur.fetchall()
+    except Exception as e:
+        logger.error(f'DB error occurred while attempting to fetch the courses tracked by {user_id}: {e}')
+        return []
+
+
+async def fetch_watcher_counts(conn):
+    try:
+        async with conn.cursor() as cur:
+            await cur.execute('SELECT class_id, COUNT(*) FROM user_interests GROUP BY class_id')
+            return dict(await cur.fetchall())
+    except Exception as e:
+        logger.error(f'DB error occurred while attempting to count watchers per course: {e}')
+        return {}
+
+
+async def add_status_transitions(conn, transition_tuples):
+    try:
+        async with conn.cursor() as cur:
+            # Transitions already stored for the same second are kept; the new one goes after them.
+            await cur.executemany('''
+                INSERT INTO status_transitions (class_id, changed_at, seq, status)
+                SELECT ?1, ?2, COUNT(*), ?3 FROM status_transitions WHERE class_id = ?1 AND changed_at = ?2
+            ''', transition_tuples)
+            await conn.commit()
+            return True
+    except Exception as e:
+        logger.error(f'DB error occurred while trying to add {len(transition_tuples)} status transitions: {e}')
+        return False
+
+
+async def fetch_classes_with_history(conn):
+    try:
+        async with conn.cursor() as cur:
+            await cur.execute('SELECT DISTINCT class_id FROM status_transitions')
+            return {row[0] for row in await cur.fetchall()}
+    except Exception as e:
+        logger.error(f'DB error occurred while attempting to fetch the classes with status history: {e}')
+        return set()
+
+
+async def fetch_transitions_for_rollup(conn, since):
+    try:
+        async with conn.cursor() as cur:
+            # Each class's last transition before the window gives its status when the window starts.
+            await cur.execute("""
+                SELECT class_id, changed_at, status FROM (
+                    SELECT status_transitions.class_id, status_transitions.changed_at, status_transitions.seq, status_transitions.status
+                    FROM (SELECT CAST(class_id AS INTEGER) AS class_id FROM courses) AS classes
+                    JOIN status_transitions ON status_transitions.class_id = classes.class_id
+                        AND status_transitions.changed_at = (
+                            SELECT MAX(changed_at) FROM status_transitions AS earlier
+                            WHERE earlier.class_id = classes.class_id AND earlier.changed_at < ?
+                        )
+                    UNION ALL
+                    SELECT class_id, changed_at, seq, status FROM status_transitions WHERE changed_at >= ?
+                )
+                ORDER BY class_id, changed_at, seq
+            """, (since, since))
+            return await cur.fetchall()
+    except Exception as e:
+        logger.error(f'DB error occurred while attempting to fetch status transitions since {since}: {e}')
+        return []
+
+
+async def get_last_rollup_day(conn):
+    try:
+        async with conn.cursor() as cur:
+            await cur.execute('SELECT MAX(day) FROM status_daily_rollups')
+            return (await cur.fetchone())[0]
+    except Exception as e:
+        logger.error(f'DB error occurred while attempting to get the last rolled up day: {e}')
+        return None
+
+
+async def get_first_transition_time(conn):
+    try:
+        async with conn.cursor() as cur:
+            await cur.execute('SELECT MIN(changed_at) FROM status_transitions')
+            return (await cur.fetchone())[0]
+    except Exception as e:
+        logger.error(f'DB error occurred while attempting to get the first status transition: {e}')
+        return None
+
+
+async def save_status_rollups(conn, daily_tuples, hourly_tuples):
+    try:
+        async with conn.cursor() as cur:
+            await cur.executemany('INSERT OR REPLACE INTO status_daily_rollups VALUES (?, ?, ?, ?)', daily_tuples)
+            await cur.executemany('INSERT OR REPLACE INTO status_hourly_flips VALUES (?, ?, ?)', hourly_tuples)
+            await conn.commit()
+            return True
+    except Exception as e:
+        logger.error(f'DB error occurred while trying to save status rollups: {e}')
+        return False
+
+
+async def prune_status_transitions(conn, before):
+    try:
+        async with conn.cursor() as cur:
+            # The newest transition before the cutoff is kept for each class, since later rollups start from it.
+            await cur.execute("""
+                DELETE FROM status_transitions
+                WHERE changed_at < ? AND changed_at < (
+                    SELECT MAX(changed_at) FROM status_transitions AS earlier
+                    WHERE earlier.class_id = status_transitions.class_id AND earlier.changed_at < ?
+                )
+            """, (before, before))
+            deleted = cur.rowcount
+            await conn.commit()
+            return deleted
+    except Exception as e:
+        logger.error(f'DB error occurred while trying to prune status transitions before {before}: {e}')
+        return 0
+
+
+async def fetch_course_daily_rollups(conn, class_id, first_day):
+    try:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                SELECT day, open_seconds, flips FROM status_daily_rollups
+                WHERE class_id = ? AND day >= ?
+                ORDER BY day
+            """, (class_id, first_day))
+            return await cur.fetchall()
+    except Exception as e:
+        logger.error(f'DB error occurred while attempting to fetch daily rollups for {class_id}: {e}')
+        return []
+
+
+async def fetch_course_hourly_flips(conn, class_id, first_hour):
+    try:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                SELECT hour, flips FROM status_hourly_flips
+                WHERE class_id = ? AND hour >= ?
+                ORDER BY hour
+            """, (class_id, first_hour))
+            return await cur.fetchall()
+    except Exception as e:
+        logger.error(f'DB error occurred while attempting to fetch hourly flips for {class_id}: {e}')
+        return []
+
+
+async def get_last_transition(conn, class_id):
+    try:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                SELECT changed_at, status FROM status_transitions
+                WHERE class_id = ?
+                ORDER BY changed_at DESC, seq DESC
+                LIMIT 1
+            """, (class_id,))
+            return await cur.fetchone()
+    except Exception as e:
+        logger.error(f'DB error occurred while attempting to get the last status transition for {class_id}: {e}')
+        return None
+
+
+async def heartbeat_worker(conn, worker_id, host, now, expired_before):
+    try:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                INSERT INTO tracker_workers (worker_id, host, started_at, heartbeat_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (worker_id) DO UPDATE SET heartbeat_at = excluded.heartbeat_at
+            """, (worker_id, host, now, now))
+            await cur.execute('DELETE FROM tracker_workers WHERE heartbeat_at < ?', (expired_before,))
+            await conn.commit()
+            return True
+    except Exception as e:
+        logger.error(f'DB error occurred while renewing the lease for worker {worker_id}: {e}')
+        return False
+
+
+async def fetch_live_workers(conn, since):
+    try:
+        async with conn.cursor() as cur:
+            await cur.execute('SELECT worker_id FROM tracker_workers WHERE heartbeat_at >= ?', (since,))
+            return [row[0] for row in await cur.fetchall()]
+    except Exception as e:
+        logger.error(f'DB error occurred while attempting to fetch live workers: {e}')
+        return []
+
+
+async def remove_worker(conn, worker_id):
+    try:
+        async with conn.cursor() as cur:
+            await cur.execute('DELETE FROM tracker_workers WHERE worker_id = ?', (worker_id,))
+            await conn.commit()
+    except Exception as e:
+        logger.error(f'DB error occurred while attempting to remove worker {worker_id}: {e}')
+
+
+async def publish_status_changes(conn, change_tuples, worker_id, now):
+    try:
+        async with conn.cursor() as cur:
+            published = 0
+            for class_id, class_name, status in change_tuples:
+                # Only the first worker to write a new status publishes it, so overlapping owners
+                # during a rebalance cannot announce the same change twice.
+                await cur.execute('UPDATE courses SET status = ? WHERE class_id = ? AND status IS NOT ?', (status, class_id, status))
+                if cur.rowcount:
+                    await cur.execute("""
+                        INSERT INTO change_events (class_id, class_name, status, worker_id, created_at)
+                        VALUES (?, ?, ?, ?, ?)
+                    """, (class_id, class_name, status, worker_id, now))
+                    published += 1
+            await conn.commit()
+            return published
+    except Exception as e:
+        logger.error(f'DB error occurred while trying to publish {len(change_tuples)} status changes: {e}')
+        return None
+
+
+async def fetch_change_events(conn, after_event_id, limit):
+    try:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                SELECT event_id, class_id, class_name, status FROM change_events
+                WHERE event_id > ?
+                ORDER BY event_id
+                LIMIT ?
+            """, (after_event_id, limit))
+            return await cur.fetchall()
+    except Exception as e:
+        logger.error(f'DB error occurred while attempting to fetch change events after {after_event_id}: {e}')
+        return []
+
+
+async def get_last_event_id(conn):
+    try:
+        async with conn.cursor() as cur:
+            await cur.execute('SELECT COALESCE(MAX(event_id), 0) FROM change_events')
+            return (await cur.fetchone())[0]
+    except Exception as e:
+        logger.error(f'DB error occurred while attempting to get the last change event: {e}')
+        return None
+
+
+async def get_event_cursor(conn, consumer):
+    try:
+        async with conn.cursor() as cur:
+            await cur.execute('SELECT last_event_id FROM event_cursors WHERE consumer = ?', (consumer,))
+            row = await cur.fetchone()
+            return row[0] if row else None
+    except Exception as e:
+        logger.error(f'DB error occurred while attempting to get the event cursor for {consumer}: {e}')
+        return None
+
+
+async def set_event_cursor(conn, consumer, last_event_id):
+    try:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                INSERT INTO event_cursors (consumer, last_event_id) VALUES (?, ?)
+                ON CONFLICT (consumer) DO UPDATE SET last_event_id = excluded.last_event_id
+            """, (consumer, last_event_id))
+            await conn.commit()
+            return True
+    except Exception as e:
+        logger.error(f'DB error occurred while trying to save the event cursor for {consumer}: {e}')
+        return False
+
+
+async def prune_change_events(conn, through_event_id, before):
+    try:
+        async with conn.cursor() as cur:
+            await cur.execute('DELETE FROM change_events WHERE event_id <= ? AND created_at < ?', (through_event_id, before))
+            deleted = cur.rowcount
+            await conn.commit()
+            return deleted
+    except Exception as e:
+        logger.error(f'DB error occurred while trying to prune change events: {e}')
+        return 0
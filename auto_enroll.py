@@ -0,0 +1,152 @@
+import json
+import time
+import asyncio
+from collections import namedtuple
+import change_stream
+import metrics
+import logger_utility
+
+logger = logger_utility.setup_logger(__name__, 'auto_enroll.log')
+
+# For a swap, drop_class_id is the class given up for class_id. For an add it is class_id again.
+EnrollTarget = namedtuple('EnrollTarget', ['class_id', 'action', 'term', 'drop_class_id', 'institution'])
+ACTIONS = ('add', 'swap')
+
+
+def load_targets(path):
+    """Reads a JSON list of {"class_id", "action", "term", "drop_class_id", "institution"} objects.
+
+    drop_class_id is only needed for a swap, and institution defaults to QNS01."""
+    with open(path) as f:
+        entries = json.load(f)
+    targets = []
+    for entry in entries:
+        action = entry.get('action', 'add').lower()
+        if action not in ACTIONS:
+            raise ValueError(f'Invalid auto enroll action. Expected one of {ACTIONS}, but got {action}.')
+        class_id = str(entry['class_id'])
+        drop_class_id = str(entry['drop_class_id']) if action == 'swap' else class_id
+        targets.append(EnrollTarget(class_id, action, entry['term'], drop_class_id, entry.get('institution', 'QNS01')))
+    return targets
+
+
+class EnrollPipeline:
+    """Fires a prepared Schedule Builder action the moment a target class changes to Open.
+
+    Everything that can be done ahead of time is: the session is logged in and kept warm, and the
+    parameters for each action are built when it is armed. A target is disarmed once its action goes through."""
+
+    def __init__(self, tracker, client, targets, keepalive_interval=60, registry=None):
+        self.tracker = tracker
+        self.client = client
+        self.targets = {target.class_id: target for target in targets}
+        self.keepalive_interval = keepalive_interval
+        self.prepared = {}
+        self.firings = []
+        self.firing = set()
+        self.tasks = set()
+        # Subscribed from the start, so changes seen while arming are not missed.
+        self.subscription = tracker.changes.subscribe('auto_enroll', policy=change_stream.COALESCE)
+
+        registry = registry or tracker.metrics
+        self.stage_seconds = registry.histogram(
+            'enroll_stage_seconds', 'Time between stages of an auto enroll, from the status change to the action response.',
+            ('stage',), metrics.PARSE_BUCKETS + (5, 10)
+        )
+        self.fired = registry.counter('enroll_actions_total', 'Auto enroll actions fired, by outcome.', ('result',))
+
+    async def log_in(self):
+        # A failed login (bad credentials, Schedule Builder down) is retried rather than switching auto enroll off.
+        while True:
+            try:
+                await self.client.keep_alive()
+                return
+            except Exception as e:
+                logger.error(f'Could not log in to Schedule Builder for auto enroll: {e}\nTrying again in {self.keepalive_interval} seconds.')
+                await asyncio.sleep(self.keepalive_interval)
+
+    async def arm(self):
+        await self.tracker.initialize_db()
+        await self.log_in()
+        for class_id, target in self.targets.items():
+            try:
+                if not await self.tracker.get_course_info(class_id):
+                    # The tracker has to be polling a class to see it open.
+                    if not await self.tracker.add_new_course_to_db(class_id, target.term, target.institution):
+                        raise ValueError(f'Could not start tracking {class_id}.')
+                self.prepared[class_id] = await self.client.prepare(target.action, target.term, target.drop_class_id, class_id,
+                                                                    target.institution)
+            except Exception as e:
+                logger.error(f'Could not arm auto enroll for {class_id}: {e}')
+        logger.info(f'Armed auto enroll for {len(self.prepared)} of {len(self.targets)} classes: {sorted(self.prepared)}')
+
+    async def fire(self, target, event, received_at):
+        options, perform = self.prepared[target.class_id]
+        submitted_at = time.time()
+        message = await self.client.run_prepared(target.action, options, perform)
+        responded_at = time.time()
+
+        firing = {
+            'class_id': target.class_id,
+            'action': target.action,
+            'detected_at': event.changed_at,
+            'received_at': received_at,
+            'submitted_at': submitted_at,
+            'responded_at': responded_at,
+            'message': message
+        }
+        self.firings.append(firing)
+        self.stage_seconds.observe(received_at - event.changed_at, stage='detect_to_dispatch')
+        self.stage_seconds.observe(submitted_at - received_at, stage='dispatch_to_submit')
+        self.stage_seconds.observe(responded_at - submitted_at, stage='submit_to_response')
+        logger.info(f'Auto enroll {target.action} for {target.class_id} returned "{message}". Detect to submit took '
+                    f'{(submitted_at - event.changed_at) * 1000:.0f} ms and the response {(responded_at - submitted_at) * 1000:.0f} ms more.')
+        if message:
+            self.fired.inc(result='done')
+            self.prepared.pop(target.class_id, None)
+        else:
+            # Stays armed, so the next time the class opens is tried again.
+            self.fired.inc(result='failed')
+        return firing
+
+    async def fire_safely(self, target, event, received_at):
+        try:
+            await self.fire(target, event, received_at)
+        except Exception as e:
+            self.fired.inc(result='error')
+            logger.error(f'An error occurred while firing auto enroll for {target.class_id}: {e}')
+        finally:
+            self.firing.discard(target.class_id)
+
+    async def keep_warm(self):
+        while True:
+            await asyncio.sleep(self.keepalive_interval)
+            try:
+                await self.client.keep_alive(margin=self.keepalive_interval * 2)
+            except Exception as e:
+                logger.error(f'Could not keep the Schedule Builder session alive: {e}')
+
+    async def run(self):
+        """Arms every target and fires on status changes until cancelled."""
+        keepalive = None
+        try:
+            await self.arm()
+            keepalive = asyncio.create_task(self.keep_warm())
+            async for event in self.subscription:
+                target = self.targets.get(event.class_id)
+                if not target or event.status != 'Open' or target.class_id not in self.prepared or target.class_id in self.firing:
+                    continue
+                # Each firing gets its own task so reading the stream never waits on Schedule Builder. The actions
+                # themselves still go out one at a time, since they share the session's action lock.
+                self.firing.add(target.class_id)
+                task = asyncio.create_task(self.fire_safely(target, event, time.time()))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+        except Exception as e:
+            logger.error(f'Auto enroll stopped because of an error: {e}')
+            raise
+        finally:
+            if keepalive:
+                keepalive.cancel()
+            self.subscription.close()
+            await self.client.close()
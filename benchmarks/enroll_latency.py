@@ -0,0 +1,148 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import contextlib
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_global_search import FakeGlobalSearch
+from fake_schedule_builder import FakeScheduleBuilder
+from load_benchmark import TERM, FIRST_CLASS_ID, percentile, format_optional
+
+
+async def populate(tracker, class_ids):
+    async with tracker.db.writer() as conn:
+        await conn.executemany('INSERT INTO courses (class_id, status, year_term, institution) VALUES (?, ?, ?, ?)',
+                               [(class_id, 'Close', TERM, 'QNS01') for class_id in class_ids])
+        await conn.executemany('INSERT INTO course_details VALUES (?, ?, ?, ?)',
+                               [(class_id, f'CSCI {100 + i}', 'MoWe 10:45AM - 12:00PM', 'Jane Doe') for i, class_id in enumerate(class_ids)])
+        await conn.commit()
+
+
+async def run_trials(args):
+    """Opens each target class at the Global Search stand-in in turn and times the pipeline's way to Schedule Builder."""
+    import global_search
+    import schedule_builder
+    import auto_enroll
+
+    class_ids = [str(class_id) for class_id in range(FIRST_CLASS_ID, FIRST_CLASS_ID + args.courses)]
+    targets = class_ids[:args.trials]
+    search = FakeGlobalSearch(args.latency, seed=args.seed)
+    search.reset(class_ids)
+    for class_id in class_ids:
+        search.statuses[class_id] = 'Close'
+    builder = FakeScheduleBuilder(args.builder_latency)
+    search_runner, search_url = await search.start()
+    builder_runner = await builder.start()
+
+    tracker = global_search.CourseTracker(database=os.path.join(os.getcwd(), 'classes.db'), search_url=search_url,
+                                          requests_per_second=args.rate, burst=args.burst, snapshot_path='')
+    tracker.governor.max_rate = max(tracker.governor.max_rate, args.rate)
+    await tracker.initialize_db()
+    await populate(tracker, class_ids)
+    client = schedule_builder.ScheduleBuilderClient(tracker.db, credentials={}, registry=tracker.metrics, **builder.client_options())
+    pipeline = auto_enroll.EnrollPipeline(
+        tracker, client, [auto_enroll.EnrollTarget(class_id, 'add', TERM, class_id, 'QNS01') for class_id in targets]
+    )
+
+    pipeline_task = asyncio.create_task(pipeline.run())
+    tracking_task = asyncio.create_task(tracker.start_tracking())
+    trials = []
+    try:
+        await asyncio.sleep(args.warmup)
+        for class_id in targets:
+            opened_at = time.time()
+            search.statuses[class_id] = 'Open'
+            deadline = time.monotonic() + args.timeout
+            while not any(firing['class_id'] == class_id for firing in pipeline.firings) and time.monotonic() < deadline:
+                await asyncio.sleep(0.005)
+            firing = next((firing for firing in pipeline.firings if firing['class_id'] == class_id), None)
+            received = [action[0] for action in builder.actions if action[2] and action[2].endswith(f'_{class_id}--')]
+            trials.append({
+                'class_id': class_id,
+                'opened_at': opened_at,
+                'firing': firing,
+                'builder_received_at': received[0] if received else None
+            })
+            await asyncio.sleep(args.gap)
+    finally:
+        for task in (pipeline_task, tracking_task):
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        await client.close()
+        await tracker.close()
+        await builder.stop(builder_runner)
+        await search.stop(search_runner)
+    return trials, builder.logins
+
+
+def milliseconds(seconds):
+    return format_optional(seconds * 1000 if seconds is not None else None, '.1f')
+
+
+def summarize(trials, logins):
+    stages = {'open_to_detect': [], 'detect_to_submit': [], 'submit_to_received': [], 'detect_to_received': []}
+    missed = 0
+    for trial in trials:
+        firing = trial['firing']
+        if not firing or trial['builder_received_at'] is None:
+            missed += 1
+            continue
+        stages['open_to_detect'].append(firing['detected_at'] - trial['opened_at'])
+        stages['detect_to_submit'].append(firing['submitted_at'] - firing['detected_at'])
+        stages['submit_to_received'].append(trial['builder_received_at'] - firing['submitted_at'])
+        stages['detect_to_received'].append(trial['builder_received_at'] - firing['detected_at'])
+    return {
+        'trials': len(trials),
+        'missed': missed,
+        'logins': logins,
+        'stages_ms': {
+            stage: {'p50': milliseconds(percentile(values, 0.5)), 'p95': milliseconds(percentile(values, 0.95))}
+            for stage, values in stages.items()
+        }
+    }
+
+
+def print_report(summary):
+    print(f'{summary["trials"]} classes opened, {summary["missed"]} missed, {summary["logins"]} Schedule Builder logins')
+    print(f'{"stage":<22}{"p50 (ms)":>10}{"p95 (ms)":>10}')
+    for stage, values in summary['stages_ms'].items():
+        print(f'{stage:<22}{values["p50"]:>10}{values["p95"]:>10}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Times the enroll-on-open pipeline end to end against local Global Search and Schedule Builder stand-ins.')
+    parser.add_argument('--courses', type=int, default=50, help='Tracked courses, all Closed to begin with.')
+    parser.add_argument('--trials', type=int, default=10, help='Classes opened one after another, each with an add armed.')
+    parser.add_argument('--rate', type=float, default=20.0, help='Requests per second for the tracker.')
+    parser.add_argument('--burst', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds the Global Search stand-in holds each response for.')
+    parser.add_argument('--builder-latency', type=float, default=0.05, help='Seconds the Schedule Builder stand-in holds each response for.')
+    parser.add_argument('--warmup', type=float, default=3.0, help='Seconds to track before the first class opens.')
+    parser.add_argument('--gap', type=float, default=0.5, help='Seconds between trials.')
+    parser.add_argument('--timeout', type=float, default=30.0, help='Seconds to wait for a class to be enrolled before counting it missed.')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', help='Also write the summary to this file.')
+    args = parser.parse_args()
+
+    # The tracker's logs and database go to a scratch directory instead of the repository.
+    json_path = os.path.abspath(args.json) if args.json else None
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            trials, logins = asyncio.run(run_trials(args))
+    summary = summarize(trials, logins)
+    print_report(summary)
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump({'summary': summary, 'trials': trials}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
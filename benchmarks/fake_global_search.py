@@ -0,0 +1,203 @@
+import os
+import time
+import uuid
+import base64
+import random
+import asyncio
+import argparse
+from aiohttp import web
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fixtures', 'global_search')
+LISTING_DIR = os.path.join(FIXTURE_DIR, 'listings')
+CONTROLLER_PATH = '/CFGlobalSearchTool/CFSearchToolController'
+TEMPLATE_CLASS_ID = '>41286<'
+OPEN_IMAGE = 'open.jpg" alt="Open" title="Open"'
+CLOSED_IMAGE = 'closed.jpg" alt="Close" title="Close"'
+SEARCH_PAGE = '<html><body><h1>Search Criteria</h1><form name="searchform"></form></body></html>'
+
+
+def split_listing(page):
+    """Splits the saved CSCI listing into the page around its sections and one section row to copy."""
+    row_at = page.index(TEMPLATE_CLASS_ID)
+    row = page[page.rindex('<tr>', 0, row_at):page.index('</tr>', row_at) + len('</tr>')]
+    head = page[:page.index('<tbody>') + len('<tbody>')]
+    tail = '\n      </tbody>\n    </table>\n  </div>\n</div>\n' + page[page.index('<div id="footer"'):]
+    return head, row, tail
+
+
+class FakeGlobalSearch:
+    """Stands in for CFSearchToolController: session POSTs, search POSTs, class page GETs and randomly flipping statuses."""
+
+    def __init__(self, latency=0.05, latency_jitter=0.5, error_rate=0.0, flip_rate=0.0, seed=None, session_lifetime=None):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.flip_rate = flip_rate
+        # Like the real site, a session that has lapsed gets the Oops page instead of the class.
+        self.session_lifetime = session_lifetime
+        self.session_started = {}
+        self.random = random.Random(seed)
+
+        with open(os.path.join(FIXTURE_DIR, 'class_open.html')) as f:
+            open_page = f.read()
+        with open(os.path.join(FIXTURE_DIR, 'oops.html'), 'rb') as f:
+            self.oops_page = f.read()
+        self.templates = {'Open': open_page, 'Close': open_page.replace(OPEN_IMAGE, CLOSED_IMAGE)}
+        # Search results are built from the saved listings, with a row for every class in the searched subject.
+        with open(os.path.join(LISTING_DIR, 'results_csci.html')) as f:
+            self.listing_head, self.listing_row, self.listing_tail = split_listing(f.read())
+        with open(os.path.join(LISTING_DIR, 'results_empty.html'), 'rb') as f:
+            self.empty_listing = f.read()
+
+        self.flip_task = None
+        self.reset([])
+
+    def reset(self, class_ids, subjects=None):
+        """Starts a new run with every class in class_ids Open and all counters cleared.
+
+        subjects maps class ids to the subject whose search lists them."""
+        self.class_ids = list(class_ids)
+        self.statuses = {class_id: 'Open' for class_id in self.class_ids}
+        self.subjects = dict(subjects or {})
+        self.flips = []
+        self.first_polled = {}
+        self.sessions = 0
+        self.requests = 0
+        self.listings = 0
+        self.errors = 0
+        self.expired = 0
+
+    def render(self, class_id):
+        return self.templates[self.statuses[class_id]].replace(TEMPLATE_CLASS_ID, f'>{class_id}<').encode()
+
+    def render_listing(self, subject):
+        class_ids = [class_id for class_id in self.class_ids if self.subjects.get(class_id) == subject]
+        if not class_ids:
+            return self.empty_listing
+        rows = []
+        for class_id in class_ids:
+            row = self.listing_row.replace(TEMPLATE_CLASS_ID, f'>{class_id}<')
+            rows.append(row if self.statuses[class_id] == 'Open' else row.replace(OPEN_IMAGE, CLOSED_IMAGE))
+        return (self.listing_head + ''.join(rows) + self.listing_tail).encode()
+
+    async def delay(self):
+        if self.latency:
+            await asyncio.sleep(self.latency * (1 + self.random.uniform(-self.latency_jitter, self.latency_jitter)))
+
+    def failed(self):
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+    async def handle_post(self, request):
+        await self.delay()
+        if self.failed():
+            return web.Response(status=503, text='Service Unavailable')
+        form = await request.post()
+        if 'search_btn_search' in form:
+            return self.handle_search(request, form)
+        self.sessions += 1
+        session_id = uuid.uuid4().hex
+        self.session_started[session_id] = time.monotonic()
+        response = web.Response(body=SEARCH_PAGE, content_type='text/html')
+        response.set_cookie('JSESSIONID', session_id)
+        return response
+
+    def session_expired(self, request):
+        if not self.session_lifetime:
+            return False
+        started = self.session_started.get(request.cookies.get('JSESSIONID'))
+        return started is None or time.monotonic() - started > self.session_lifetime
+
+    def handle_search(self, request, form):
+        self.requests += 1
+        self.listings += 1
+        if self.session_expired(request):
+            self.expired += 1
+            return web.Response(body=self.oops_page, content_type='text/html')
+        for class_id in self.class_ids:
+            if self.subjects.get(class_id) == form.get('subject_name'):
+                self.first_polled.setdefault(class_id, time.time())
+        return web.Response(body=self.render_listing(form.get('subject_name')), content_type='text/html')
+
+    async def handle_get(self, request):
+        await self.delay()
+        try:
+            class_id = base64.b64decode(request.query['class_number_searched']).decode()
+        except (KeyError, ValueError):
+            class_id = None
+        self.requests += 1
+        if self.failed():
+            return web.Response(status=503, text='Service Unavailable')
+        if self.session_expired(request):
+            self.expired += 1
+            return web.Response(body=self.oops_page, content_type='text/html')
+        if class_id not in self.statuses:
+            return web.Response(body=self.oops_page, content_type='text/html')
+        self.first_polled.setdefault(class_id, time.time())
+        return web.Response(body=self.render(class_id), content_type='text/html')
+
+    async def flip_statuses(self):
+        while True:
+            await asyncio.sleep(self.random.expovariate(self.flip_rate))
+            if not self.class_ids:
+                continue
+            class_id = self.random.choice(self.class_ids)
+            status = 'Close' if self.statuses[class_id] == 'Open' else 'Open'
+            self.statuses[class_id] = status
+            self.flips.append((time.time(), class_id, status))
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post(CONTROLLER_PATH, self.handle_post)
+        app.router.add_get(CONTROLLER_PATH, self.handle_get)
+        return app
+
+    async def start(self, host='127.0.0.1', port=0):
+        """Serves the stand-in in the running loop and returns (runner, url)."""
+        runner = web.AppRunner(self.make_app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        if self.flip_rate:
+            self.flip_task = asyncio.create_task(self.flip_statuses())
+        host, port = runner.addresses[0][:2]
+        return runner, f'http://{host}:{port}{CONTROLLER_PATH}'
+
+    async def stop(self, runner):
+        if self.flip_task:
+            self.flip_task.cancel()
+        await runner.cleanup()
+
+
+async def serve(args):
+    server = FakeGlobalSearch(args.latency, args.latency_jitter, args.error_rate, args.flip_rate, args.seed, args.session_lifetime)
+    class_ids = [str(class_id) for class_id in range(args.first_class_id, args.first_class_id + args.courses)]
+    # Every class page names CSCI 111, so every class is listed under CSCI too.
+    server.reset(class_ids, {class_id: 'CSCI' for class_id in class_ids})
+    runner, url = await server.start(args.host, args.port)
+    print(f'Serving {args.courses} classes at {url}')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop(runner)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs a local stand-in for the Global Search class pages.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--courses', type=int, default=100, help='Class numbers that have pages, starting at --first-class-id.')
+    parser.add_argument('--first-class-id', type=int, default=10000)
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds each response is held for.')
+    parser.add_argument('--latency-jitter', type=float, default=0.5, help='Fraction the latency varies by either way.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with a 503.')
+    parser.add_argument('--flip-rate', type=float, default=1.0, help='Status flips per second across all classes.')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--session-lifetime', type=float, default=None, help='Seconds before a session starts getting Oops pages.')
+    asyncio.run(serve(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+import time
+import uuid
+import asyncio
+import argparse
+from aiohttp import web
+
+LOGIN_PAGE = '<html><body><form action="/oam/server/auth_cred_submit" method="post"></form></body></html>'
+CRITERIA_PAGE = '<html><body><h1>Schedule Builder</h1></body></html>'
+ACTION_PAGE = '<html><body><div class="actionInfoMessage">{message}</div></body></html>'
+ENROLL_OPTIONS = '<?xml version="1.0"?><addcourse><options/></addcourse>'
+
+
+class FakeScheduleBuilder:
+    """Stands in for the CUNYfirst login redirect, the SSO form and Schedule Builder's enroll-options and perform-action."""
+
+    def __init__(self, latency=0.05, session_lifetime=None, username=None, password=None):
+        self.latency = latency
+        self.session_lifetime = session_lifetime
+        self.username = username
+        self.password = password
+        self.sessions = {}
+        self.logins = 0
+        self.failed_logins = 0
+        self.expired = 0
+        self.options_requests = 0
+        # (received_at, statea0, keya0, stateb0, keyb0, schoolTermId) for every perform-action.
+        self.actions = []
+        self.url = None
+
+    async def delay(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def login_page(self):
+        raise web.HTTPFound(f'{self.url}/oam/login')
+
+    def check_session(self, request):
+        started = self.sessions.get(request.cookies.get('SB_SESSION'))
+        if started is None or (self.session_lifetime and time.monotonic() - started > self.session_lifetime):
+            self.expired += 1
+            self.login_page()
+
+    async def handle_redirect(self, request):
+        await self.delay()
+        self.login_page()
+
+    async def handle_login_page(self, request):
+        return web.Response(text=LOGIN_PAGE, content_type='text/html')
+
+    async def handle_credentials(self, request):
+        await self.delay()
+        form = await request.post()
+        if (self.username and form.get('username') != self.username) or (self.password and form.get('password') != self.password):
+            self.failed_logins += 1
+            self.login_page()
+        self.logins += 1
+        session_id = uuid.uuid4().hex
+        self.sessions[session_id] = time.monotonic()
+        response = web.HTTPFound(f'{self.url}/criteria')
+        response.set_cookie('SB_SESSION', session_id)
+        raise response
+
+    async def handle_criteria(self, request):
+        return web.Response(text=CRITERIA_PAGE, content_type='text/html')
+
+    async def handle_enroll_options(self, request):
+        await self.delay()
+        self.check_session(request)
+        self.options_requests += 1
+        return web.Response(text=ENROLL_OPTIONS, content_type='text/xml')
+
+    async def handle_perform_action(self, request):
+        received_at = time.time()
+        await self.delay()
+        self.check_session(request)
+        query = request.query
+        self.actions.append((received_at, query.get('statea0'), query.get('keya0'), query.get('stateb0'), query.get('keyb0'),
+                             query.get('schoolTermId')))
+        return web.Response(text=ACTION_PAGE.format(message='This class has been added to your Shopping Cart.'), content_type='text/html')
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_get('/redirect', self.handle_redirect)
+        app.router.add_get('/oam/login', self.handle_login_page)
+        app.router.add_post('/oam/server/auth_cred_submit', self.handle_credentials)
+        app.router.add_get('/criteria', self.handle_criteria)
+        app.router.add_get('/api/enroll-options', self.handle_enroll_options)
+        app.router.add_get('/api/perform-action', self.handle_perform_action)
+        return app
+
+    def client_options(self):
+        """Keyword arguments that point a ScheduleBuilderClient at this stand-in."""
+        return {
+            'base_url': self.url,
+            'login_url': f'{self.url}/redirect',
+            'sso_url': f'{self.url}/oam/server/auth_cred_submit',
+            'sso_prefix': f'{self.url}/oam/',
+            'verify': False
+        }
+
+    async def start(self, host='127.0.0.1', port=0):
+        """Serves the stand-in in the running loop and returns the runner."""
+        runner = web.AppRunner(self.make_app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        host, port = runner.addresses[0][:2]
+        self.url = f'http://{host}:{port}'
+        return runner
+
+    async def stop(self, runner):
+        await runner.cleanup()
+
+
+async def serve(args):
+    server = FakeScheduleBuilder(args.latency, args.session_lifetime)
+    runner = await server.start(args.host, args.port)
+    print(f'Serving Schedule Builder at {server.url}')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop(runner)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs a local stand-in for the CUNYfirst login and Schedule Builder actions.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds each response is held for.')
+    parser.add_argument('--session-lifetime', type=float, default=None, help='Seconds before a session is sent back to the login page.')
+    asyncio.run(serve(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import argparse
+import resource
+import tempfile
+import contextlib
+import statistics
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_global_search import FakeGlobalSearch
+
+TERM = '2024 Spring Term'
+FIRST_CLASS_ID = 10000
+SUBJECTS = ('CSCI', 'MATH', 'BIOL', 'ACCT', 'PHYS', 'ECON', 'HIST', 'ENGL')
+NOTIFICATION_PATTERN = re.compile(r'-(\d+) is now (\w+)!$')
+
+
+class FakeChannel:
+    def __init__(self, channel_id, latency, notifications):
+        self.id = channel_id
+        self.latency = latency
+        self.notifications = notifications
+
+    async def send(self, message):
+        await asyncio.sleep(self.latency)
+        match = NOTIFICATION_PATTERN.search(message)
+        if match:
+            self.notifications.append((time.time(), match.group(1), match.group(2)))
+
+    def __str__(self):
+        return f'#bench-{self.id}'
+
+
+def class_ids_for(courses):
+    return [str(class_id) for class_id in range(FIRST_CLASS_ID, FIRST_CLASS_ID + courses)]
+
+
+def subject_for(index):
+    return SUBJECTS[index % len(SUBJECTS)]
+
+
+async def populate(tracker, args):
+    class_ids = class_ids_for(args.courses)
+    async with tracker.db.writer() as conn:
+        await conn.executemany('INSERT INTO courses (class_id, status, year_term, institution) VALUES (?, ?, ?, ?)',
+                               [(class_id, 'Open', TERM, 'QNS01') for class_id in class_ids])
+        await conn.executemany('INSERT INTO course_details VALUES (?, ?, ?, ?)', [
+            (class_id, f'{subject_for(i)} {100 + i % 300}', 'MoWe 10:45AM - 12:00PM', 'Jane Doe')
+            for i, class_id in enumerate(class_ids)
+        ])
+        await conn.executemany('INSERT OR IGNORE INTO user_interests VALUES (?, ?, ?)', [
+            (str(1000 + (i * args.users_per_course + j) % args.users), class_id, str(j % args.channels))
+            for i, class_id in enumerate(class_ids) for j in range(args.users_per_course)
+        ])
+        await conn.commit()
+
+
+async def run_worker(args):
+    """Runs the tracker and the bot's notification path against the stand-in for one course count."""
+    import global_search
+    import discord_bot
+
+    tracker = global_search.CourseTracker(
+        parse_executor_kind=args.parse_executor, requests_per_second=args.rate, burst=args.burst,
+        num_sessions=args.sessions, database=os.path.join(os.getcwd(), 'classes.db'), search_url=args.url, bulk_mode=args.bulk
+    )
+    tracker.governor.max_rate = max(tracker.governor.max_rate, args.rate)
+    tracker.max_in_flight = asyncio.BoundedSemaphore(args.in_flight)
+    await tracker.initialize_db()
+    await populate(tracker, args)
+
+    notifications = []
+    discord_bot.client.tracker = tracker
+    for channel_id in range(args.channels):
+        discord_bot.client.channel_cache[channel_id] = FakeChannel(channel_id, args.discord_latency, notifications)
+
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started_at = time.time()
+    # The bot's own start_tracking, so notifications come off the change stream just as they do in production.
+    task = asyncio.create_task(discord_bot.start_tracking())
+    try:
+        await asyncio.wait_for(asyncio.shield(task), args.duration)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+    elapsed = time.time() - started_at
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    cpu = (usage.ru_utime - usage_before.ru_utime) + (usage.ru_stime - usage_before.ru_stime)
+    cpu += (children.ru_utime - children_before.ru_utime) + (children.ru_stime - children_before.ru_stime)
+    return {
+        'started_at': started_at,
+        'elapsed': elapsed,
+        'cpu': cpu,
+        # ru_maxrss is in kilobytes on Linux.
+        'peak_rss_mb': max(usage.ru_maxrss, children.ru_maxrss) / 1024,
+        'final_rate': tracker.governor.current_rate,
+        'fingerprint_hit_rate': tracker.fingerprints.hit_rate,
+        'notifications': notifications
+    }
+
+
+def worker_main(args):
+    # The tracker's logs and database go to a scratch directory instead of the repository.
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        stdout = sys.stdout
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            result = asyncio.run(run_worker(args))
+        stdout.write(json.dumps(result) + '\n')
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def notify_latencies(flips, notifications):
+    # Each notification is matched to the latest flip of that class to that status.
+    flips_by_class = {}
+    for flipped_at, class_id, status in flips:
+        flips_by_class.setdefault(class_id, []).append((flipped_at, status))
+    latencies = []
+    for notified_at, class_id, status in notifications:
+        matching = [flipped_at for flipped_at, flip_status in flips_by_class.get(class_id, ())
+                    if flip_status == status and flipped_at <= notified_at]
+        if matching:
+            latencies.append(notified_at - max(matching))
+    return latencies
+
+
+async def run_scale(server, url, courses, args):
+    class_ids = class_ids_for(courses)
+    server.reset(class_ids, {class_id: subject_for(i) for i, class_id in enumerate(class_ids)})
+    command = [
+        sys.executable, os.path.abspath(__file__), '--worker', '--url', url, '--courses', str(courses),
+        '--duration', str(args.duration), '--rate', str(args.rate), '--burst', str(args.burst),
+        '--in-flight', str(args.in_flight), '--sessions', str(args.sessions), '--parse-executor', args.parse_executor,
+        '--users', str(args.users), '--users-per-course', str(args.users_per_course), '--channels', str(args.channels),
+        '--discord-latency', str(args.discord_latency)
+    ] + (['--bulk'] if args.bulk else [])
+    process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        print(stderr.decode()[-4000:], file=sys.stderr)
+        raise RuntimeError(f'The {courses} course run exited with code {process.returncode}.')
+    result = json.loads(stdout.decode().strip().splitlines()[-1])
+
+    notified_pairs = {(class_id, status) for _, class_id, status in result['notifications']}
+    latencies = notify_latencies(server.flips, result['notifications'])
+    first_polls = sorted(server.first_polled.values())
+    return {
+        'courses': courses,
+        'requests': server.requests,
+        'requests_per_second': server.requests / result['elapsed'],
+        'listing_requests': server.listings,
+        'errors': server.errors,
+        'expired_session_requests': server.expired,
+        'sessions': server.sessions,
+        'sweep_seconds': first_polls[-1] - result['started_at'] if len(first_polls) == courses else None,
+        'polled': len(first_polls),
+        'cpu_seconds': result['cpu'],
+        'cpu_percent': 100 * result['cpu'] / result['elapsed'],
+        'peak_rss_mb': result['peak_rss_mb'],
+        'final_rate': result['final_rate'],
+        'fingerprint_hit_rate': result['fingerprint_hit_rate'],
+        'flips': len(server.flips),
+        'notified_changes': len(notified_pairs),
+        'notifications': len(result['notifications']),
+        'notify_p50_ms': percentile(latencies, 0.5) * 1000 if latencies else None,
+        'notify_p95_ms': percentile(latencies, 0.95) * 1000 if latencies else None,
+        'notify_mean_ms': statistics.mean(latencies) * 1000 if latencies else None
+    }
+
+
+def format_optional(value, spec, missing='-'):
+    return format(value, spec) if value is not None else missing
+
+
+def print_report(results, duration):
+    print(f'{"courses":>8}{"req/s":>9}{"rate":>7}{"sweep (s)":>11}{"CPU (s)":>9}{"CPU %":>7}{"RSS (MB)":>10}'
+          f'{"errors":>8}{"flips":>7}{"notified":>10}{"p50 (ms)":>10}{"p95 (ms)":>10}')
+    for result in results:
+        sweep = format_optional(result['sweep_seconds'], '.1f', f'>{duration:.0f}')
+        print(f'{result["courses"]:>8}{result["requests_per_second"]:>9.1f}{result["final_rate"]:>7.1f}{sweep:>11}{result["cpu_seconds"]:>9.1f}'
+              f'{result["cpu_percent"]:>7.0f}{result["peak_rss_mb"]:>10.1f}{result["errors"]:>8}{result["flips"]:>7}'
+              f'{result["notified_changes"]:>10}{format_optional(result["notify_p50_ms"], ".0f"):>10}'
+              f'{format_optional(result["notify_p95_ms"], ".0f"):>10}')
+
+
+async def run_benchmark(args):
+    server = FakeGlobalSearch(args.latency, args.latency_jitter, args.error_rate, args.flip_rate, args.seed, args.session_lifetime)
+    runner, url = await server.start()
+    try:
+        results = []
+        for courses in args.courses:
+            results.append(await run_scale(server, url, courses, args))
+    finally:
+        await server.stop(runner)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load tests the tracker and notification path against a local Global Search stand-in.')
+    parser.add_argument('--courses', type=int, nargs='+', default=[100, 1000, 10000], help='Tracked course counts to run.')
+    parser.add_argument('--duration', type=float, default=60, help='Seconds to track for at each course count.')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds the stand-in holds each response for.')
+    parser.add_argument('--latency-jitter', type=float, default=0.5)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests the stand-in answers with a 503.')
+    parser.add_argument('--flip-rate', type=float, default=2.0, help='Status flips per second across all courses.')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--session-lifetime', type=float, default=None, help='Seconds before the stand-in expires a session.')
+    parser.add_argument('--rate', type=float, default=100.0, help='Starting requests per second for the tracker.')
+    parser.add_argument('--burst', type=int, default=10)
+    parser.add_argument('--in-flight', type=int, default=32, help='Polls the tracker may have running at once.')
+    parser.add_argument('--sessions', type=int, default=3)
+    parser.add_argument('--bulk', action='store_true', help='Poll subjects with enough tracked sections through their results listings.')
+    parser.add_argument('--parse-executor', choices=['thread', 'process', 'inline'], default='thread')
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--users-per-course', type=int, default=2)
+    parser.add_argument('--channels', type=int, default=20)
+    parser.add_argument('--discord-latency', type=float, default=0.05, help='Seconds each stubbed channel.send takes.')
+    parser.add_argument('--json', help='Also write the results to this file.')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        args.courses = args.courses[0]
+        worker_main(args)
+        return
+
+    results = asyncio.run(run_benchmark(args))
+    print_report(results, args.duration)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
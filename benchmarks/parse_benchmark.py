@@ -0,0 +1,85 @@
+import os
+import sys
+import json
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import course_parser
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fixtures', 'global_search')
+LISTING_FIXTURE_DIR = os.path.join(FIXTURE_DIR, 'listings')
+
+
+def load_fixtures(directory=FIXTURE_DIR):
+    with open(os.path.join(directory, 'expected.json')) as f:
+        expected = json.load(f)
+    pages = {}
+    for filename in expected:
+        with open(os.path.join(directory, filename), 'rb') as f:
+            pages[filename] = f.read()
+    return pages, expected
+
+
+def run_extractor(extractor, content):
+    try:
+        return list(extractor(content))
+    except course_parser.ClassNotFoundError:
+        return None
+
+
+def check_fixtures(pages, expected):
+    mismatches = 0
+    for filename, content in pages.items():
+        for extractor in (course_parser.extract_class_page_lxml, course_parser.extract_class_page_soup):
+            result = run_extractor(extractor, content)
+            if result != expected[filename]:
+                mismatches += 1
+                print(f'MISMATCH {extractor.__name__} on {filename}: {result} != {expected[filename]}')
+    return mismatches
+
+
+def check_listing_fixtures(pages, expected):
+    mismatches = 0
+    for filename, content in pages.items():
+        result = course_parser.extract_results_listing(content)
+        if result != expected[filename]:
+            mismatches += 1
+            print(f'MISMATCH extract_results_listing on {filename}: {result} != {expected[filename]}')
+    return mismatches
+
+
+def time_per_page(func, content, number):
+    return min(timeit.repeat(lambda: func(content), number=number, repeat=5)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures per-page parse time of the Global Search class page extractors.')
+    parser.add_argument('--number', type=int, default=200, help='Parses per timing run.')
+    args = parser.parse_args()
+
+    pages, expected = load_fixtures()
+    listing_pages, listing_expected = load_fixtures(LISTING_FIXTURE_DIR)
+    mismatches = check_fixtures(pages, expected) + check_listing_fixtures(listing_pages, listing_expected)
+
+    print(f'{"fixture":<32}{"hash (us)":>12}{"lxml (us)":>12}{"soup (us)":>12}{"speedup":>10}')
+    for filename, content in pages.items():
+        fingerprint = time_per_page(course_parser.fingerprint_class_page, content, args.number) * 1e6
+        fast = time_per_page(lambda page: run_extractor(course_parser.extract_class_page_lxml, page), content, args.number) * 1e6
+        slow = time_per_page(lambda page: run_extractor(course_parser.extract_class_page_soup, page), content, args.number) * 1e6
+        print(f'{filename:<32}{fingerprint:>12.1f}{fast:>12.1f}{slow:>12.1f}{slow / fast:>9.1f}x')
+
+    print(f'\n{"listing fixture":<32}{"sections":>12}{"lxml (us)":>12}{"us/section":>12}')
+    for filename, content in listing_pages.items():
+        listing = time_per_page(course_parser.extract_results_listing, content, args.number) * 1e6
+        sections = len(listing_expected[filename])
+        per_section = f'{listing / sections:.1f}' if sections else '-'
+        print(f'{filename:<32}{sections:>12}{listing:>12.1f}{per_section:>12}')
+
+    if mismatches:
+        print(f'{mismatches} extractor results did not match the expected.json files under fixtures/global_search')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
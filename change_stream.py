@@ -0,0 +1,119 @@
+import asyncio
+from collections import deque, namedtuple, OrderedDict
+import metrics
+import logger_utility
+
+logger = logger_utility.setup_logger(__name__, 'change_stream.log')
+
+ChangeEvent = namedtuple('ChangeEvent', ['class_id', 'class_name', 'status', 'changed_at'])
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+# Keeps only the latest event per course, which is all a notification needs.
+COALESCE = 'coalesce'
+POLICIES = (DROP_OLDEST, DROP_NEWEST, COALESCE)
+
+
+class Subscription:
+    def __init__(self, stream, name, maxsize, policy):
+        if policy not in POLICIES:
+            raise ValueError(f'Invalid lag policy. Expected one of {POLICIES}, but got {policy}.')
+        self.stream = stream
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+        self.events = OrderedDict() if policy == COALESCE else deque()
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.events)
+
+    def put(self, event):
+        if self.closed:
+            return
+        if self.policy == COALESCE:
+            if self.events.pop(event.class_id, None) is not None:
+                self.stream.record_drop(self)
+            self.events[event.class_id] = event
+            if len(self.events) > self.maxsize:
+                self.events.popitem(last=False)
+                self.stream.record_drop(self)
+        elif len(self.events) >= self.maxsize:
+            self.stream.record_drop(self)
+            if self.policy == DROP_NEWEST:
+                return
+            self.events.popleft()
+            self.events.append(event)
+        else:
+            self.events.append(event)
+        self.ready.set()
+
+    def pop(self):
+        if self.policy == COALESCE:
+            return self.events.popitem(last=False)[1]
+        return self.events.popleft()
+
+    async def get(self):
+        """Returns the next event, or None once the subscription is closed and drained."""
+        while not self.events:
+            if self.closed:
+                return None
+            self.ready.clear()
+            await self.ready.wait()
+        return self.pop()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self.get()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+        self.stream.unsubscribe(self)
+
+
+class ChangeStream:
+    """Fans status changes out to any number of subscribers without ever blocking the publisher.
+
+    Each subscriber has its own bounded queue. When a subscriber falls behind, its lag policy
+    decides what is lost, and only that subscriber is affected."""
+
+    def __init__(self, registry=None):
+        self.subscriptions = []
+        registry = registry or metrics.MetricsRegistry()
+        self.published = registry.counter('tracker_change_events_total', 'Status changes published to the change stream.')
+        self.dropped = registry.counter(
+            'tracker_change_events_dropped_total', 'Change events a lagging subscriber lost to its lag policy.', ('subscriber',)
+        )
+        registry.gauge('tracker_change_subscribers', 'Subscribers to the change stream.', func=lambda: len(self.subscriptions))
+
+    def subscribe(self, name, maxsize=1000, policy=DROP_OLDEST):
+        subscription = Subscription(self, name, maxsize, policy)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        if subscription in self.subscriptions:
+            self.subscriptions.remove(subscription)
+
+    def publish(self, event):
+        self.published.inc()
+        for subscription in self.subscriptions:
+            subscription.put(event)
+
+    def record_drop(self, subscription):
+        if not subscription.dropped:
+            logger.warning(f'Subscriber {subscription.name} is lagging and has started losing change events.')
+        subscription.dropped += 1
+        self.dropped.inc(subscriber=subscription.name)
+
+    def close(self):
+        for subscription in list(self.subscriptions):
+            subscription.close()
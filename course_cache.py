@@ -0,0 +1,86 @@
+import time
+from collections import OrderedDict
+
+
+class CourseCache:
+    def __init__(self, ttl=300, max_size=2048):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.courses = OrderedDict()
+        self.user_interests = OrderedDict()
+        self.listing = None
+        self.listing_expires_at = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def lookup(self, entries, key):
+        entry = entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        if entry:
+            del entries[key]
+        self.misses += 1
+        return None
+
+    def store(self, entries, key, value):
+        entries[key] = (time.monotonic() + self.ttl, value)
+        entries.move_to_end(key)
+        while len(entries) > self.max_size:
+            entries.popitem(last=False)
+
+    async def get_course(self, class_id, load):
+        row = self.lookup(self.courses, class_id)
+        if row is None:
+            row = await load(class_id)
+            if row:
+                self.store(self.courses, class_id, row)
+        return row
+
+    async def get_listing(self, load):
+        if self.listing is not None and self.listing_expires_at > time.monotonic():
+            self.hits += 1
+            return list(self.listing.items())
+        self.misses += 1
+        self.listing = {class_id: (class_name, status) for class_id, class_name, status in await load()}
+        self.listing_expires_at = time.monotonic() + self.ttl
+        return list(self.listing.items())
+
+    async def get_user_interests(self, user_id, load):
+        class_ids = self.lookup(self.user_interests, user_id)
+        if class_ids is None:
+            class_ids = await load(user_id)
+            self.store(self.user_interests, user_id, class_ids)
+        return class_ids
+
+    def put_course(self, row):
+        class_id, status, _, class_name, _, _ = row
+        self.store(self.courses, class_id, row)
+        if self.listing is not None:
+            self.listing[class_id] = (class_name, status)
+
+    def update_status(self, class_id, status):
+        # Write-through from the tracker, so cached rows never show a stale status.
+        entry = self.courses.get(class_id)
+        if entry:
+            expires_at, row = entry
+            self.courses[class_id] = (expires_at, (row[0], status) + row[2:])
+        if self.listing is not None and class_id in self.listing:
+            self.listing[class_id] = (self.listing[class_id][0], status)
+
+    def invalidate_course(self, class_id):
+        self.courses.pop(class_id, None)
+        if self.listing is not None:
+            self.listing.pop(class_id, None)
+        for user_id, (_, class_ids) in list(self.user_interests.items()):
+            if class_id in class_ids:
+                del self.user_interests[user_id]
+
+    def invalidate_user(self, user_id):
+        self.user_interests.pop(str(user_id), None)
@@ -0,0 +1,217 @@
+import re
+import zlib
+from collections import OrderedDict
+from bs4 import BeautifulSoup
+from lxml import etree
+import logger_utility
+
+logger = logger_utility.setup_logger(__name__, 'course_parser.log')
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+CLASS_NAME_PATTERN = re.compile(r'\b[A-Z]+\s\d+')
+CLASS_NUMBER_PATTERN = re.compile(r'\d+')
+OOPS_HEADING_PATTERN = re.compile(rb'<h1[^>]*>[^<]*Oops')
+
+# One parser is shared by every call. Comments are dropped so that itertext() matches BeautifulSoup's get_text().
+HTML_PARSER = etree.HTMLParser(remove_comments=True, remove_pis=True)
+
+FIRST_HEADING = etree.XPath('(//h1)[1]')
+SHADOWBOX_PARAGRAPH = etree.XPath('((//div[contains(concat(" ", normalize-space(@class), " "), " shadowbox ")])[1]//p)[1]')
+# Same as soup.find('td', string=re.compile('\d+')): the first <td> with a single child that contains a digit.
+CLASS_NUMBER_CELL = etree.XPath('(//td[count(node()) = 1][translate(., "0123456789", "") != string(.)])[1]')
+STATUS_ALT = etree.XPath('(//img[@alt = "Open" or @alt = "Close"])[1]/@alt')
+DAYS_AND_TIMES_CELL = etree.XPath('(//td[@data-label = "Days And Times"])[1]')
+INSTRUCTOR_CELL = etree.XPath('(//td[@data-label = "Instructor"])[1]')
+LISTING_ROWS = etree.XPath('//tr[td[@data-label = "Class"]]')
+LISTING_CLASS_CELL = etree.XPath('td[@data-label = "Class"][1]')
+LISTING_STATUS_ALT = etree.XPath('td[@data-label = "Status"][1]//img/@alt')
+STATUSES = ('Open', 'Close')
+
+
+class ClassNotFoundError(ValueError):
+    pass
+
+
+def stripped_text(element):
+    if element is None:
+        return None
+    return ''.join(text.strip() for text in element.itertext())
+
+
+def first_or_none(results):
+    return results[0] if results else None
+
+
+def extract_class_page_lxml(content):
+    root = etree.fromstring(content, HTML_PARSER)
+    if root is None:
+        raise ValueError('The webpage was empty.')
+
+    error_message = first_or_none(FIRST_HEADING(root))
+    if error_message is not None and 'Oops' in stripped_text(error_message):
+        raise ClassNotFoundError('The class does not exist.')
+
+    full_class_name = stripped_text(first_or_none(SHADOWBOX_PARAGRAPH(root)))
+    class_id = stripped_text(first_or_none(CLASS_NUMBER_CELL(root)))
+    status = first_or_none(STATUS_ALT(root))
+    if not full_class_name or not class_id or not status:
+        raise ValueError('Failed to find the class name, class number or status in the HTML.')
+
+    class_name = CLASS_NAME_PATTERN.search(full_class_name)
+    if not class_name:
+        raise ValueError(f'Could not find a course code in "{full_class_name}".')
+    times = stripped_text(first_or_none(DAYS_AND_TIMES_CELL(root)))
+    professor = stripped_text(first_or_none(INSTRUCTOR_CELL(root)))
+    return (class_id, class_name.group(), str(status), times, professor)
+
+
+def extract_class_page_soup(content):
+    soup = BeautifulSoup(content, 'lxml')
+
+    error_message = soup.find('h1')
+    if error_message and 'Oops' in error_message.text:
+        raise ClassNotFoundError('The class does not exist.')
+
+    shadowbox = soup.find('div', {'class': 'shadowbox'})
+    paragraph = shadowbox.find('p') if shadowbox else None
+    full_class_name = paragraph.get_text(strip=True) if paragraph else None
+    class_number_cell = soup.find('td', string=CLASS_NUMBER_PATTERN)
+    class_id = class_number_cell.get_text(strip=True) if class_number_cell else None
+    status_image = soup.find('img', alt=['Open', 'Close'])
+    status = status_image['alt'] if status_image else None
+    if not full_class_name or not class_id or not status:
+        raise ValueError('Failed to find the class name, class number or status in the HTML.')
+
+    class_name = CLASS_NAME_PATTERN.search(full_class_name)
+    if not class_name:
+        raise ValueError(f'Could not find a course code in "{full_class_name}".')
+    times = soup.find('td', {'data-label': 'Days And Times'})
+    professor = soup.find('td', {'data-label': 'Instructor'})
+    return (
+        class_id,
+        class_name.group(),
+        status,
+        times.get_text(strip=True) if times else None,
+        professor.get_text(strip=True) if professor else None
+    )
+
+
+def extract_class_page(content, verify=False):
+    """Returns (class_id, class_name, status, times, professor) for a Global Search class page.
+
+    The lxml path is tried first and BeautifulSoup is used if it fails. With verify=True both
+    are run and any disagreement is logged, with the BeautifulSoup result taken as correct."""
+    try:
+        result = extract_class_page_lxml(content)
+    except ClassNotFoundError:
+        raise
+    except Exception as e:
+        logger.warning(f'Fast class page extraction failed, falling back to BeautifulSoup: {e}')
+        return extract_class_page_soup(content)
+
+    if verify:
+        expected = extract_class_page_soup(content)
+        if result != expected:
+            logger.warning(f'Fast class page extraction disagreed with BeautifulSoup: {result} != {expected}')
+            return expected
+    return result
+
+
+def extract_results_listing(content):
+    """Returns {class_id: status} for every section on a Global Search results page.
+
+    Sections whose status is not Open or Close (e.g. Wait List) are left out so that
+    callers fall back to the class page for them."""
+    root = etree.fromstring(content, HTML_PARSER)
+    if root is None:
+        raise ValueError('The webpage was empty.')
+
+    statuses = {}
+    for row in LISTING_ROWS(root):
+        class_id = stripped_text(first_or_none(LISTING_CLASS_CELL(row)))
+        status = first_or_none(LISTING_STATUS_ALT(row))
+        if class_id and class_id.isdigit() and status in STATUSES:
+            statuses[class_id] = str(status)
+    return statuses
+
+
+def is_oops_page(content):
+    # Global Search shows this page both for a class that does not exist and for a lapsed session.
+    return OOPS_HEADING_PATTERN.search(content) is not None
+
+
+def class_page_problem(content):
+    """Returns why content is not a usable class page, or None if it looks like one.
+
+    Only byte searches are used, so this is cheap enough to run on every response
+    and tell a lapsed session apart from a page that merely failed to parse. The Oops
+    page is not a problem here, since it is also the answer for a class that does not exist."""
+    if is_oops_page(content):
+        return None
+    if b'shadowbox' not in content:
+        return 'a page without the shadowbox markup'
+    return None
+
+
+def listing_page_problem(content):
+    """Returns why content is not a results listing, or None if it is one, with or without sections.
+
+    A lapsed session's Oops page or the Search Criteria page also comes back as a 200, and
+    would otherwise parse as a listing with no sections on it."""
+    if b'data-label="Class"' in content or b'returned no results' in content:
+        return None
+    if is_oops_page(content):
+        return 'an Oops page instead of a listing'
+    return 'a page without listing rows'
+
+
+def fingerprint_class_page(content):
+    # Only the shadowbox holds class data; anything before it (headers, scripts, tokens) is ignored
+    # so that cosmetic changes elsewhere on the page do not force a re-parse.
+    start = content.find(b'shadowbox')
+    region = memoryview(content)[start:] if start != -1 else memoryview(content)
+    if xxhash:
+        return xxhash.xxh64_intdigest(region)
+    return (len(region) << 32) | zlib.crc32(region)
+
+
+class FingerprintCache:
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get(self, class_id, fingerprint):
+        entry = self.entries.get(class_id)
+        if entry and entry[0] == fingerprint:
+            self.entries.move_to_end(class_id)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def put(self, class_id, fingerprint, result):
+        self.entries[class_id] = (fingerprint, result)
+        self.entries.move_to_end(class_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def discard(self, class_id):
+        self.entries.pop(class_id, None)
+
+    def snapshot(self):
+        return [[class_id, fingerprint, list(result)] for class_id, (fingerprint, result) in self.entries.items()]
+
+    def restore(self, entries):
+        for class_id, fingerprint, result in entries:
+            self.put(class_id, fingerprint, tuple(result))
@@ -2,40 +2,203 @@ import logger_utility
 
 logger = logger_utility.setup_logger(__name__, 'create_db.log')
 
+
+async def create_base_tables(cursor):
+    await cursor.execute("""
+        CREATE TABLE IF NOT EXISTS term_info (
+            year_term TEXT PRIMARY KEY,
+            hidden_value TEXT,
+            term_id TEXT
+        )
+    """)
+    await cursor.execute("""
+        CREATE TABLE IF NOT EXISTS courses (
+            class_id TEXT PRIMARY KEY,
+            status TEXT,
+            year_term TEXT REFERENCES term_info(year_term),
+            institution TEXT NOT NULL DEFAULT 'QNS01'
+        )
+    """)
+    await cursor.execute('PRAGMA table_info(courses)')
+    if 'institution' not in [column[1] for column in await cursor.fetchall()]:
+        # Databases created before multi-institution tracking only ever held Queens College courses.
+        await cursor.execute("ALTER TABLE courses ADD COLUMN institution TEXT NOT NULL DEFAULT 'QNS01'")
+        logger.info('Added the institution column to courses.')
+    await cursor.execute("""
+        CREATE TABLE IF NOT EXISTS course_details (
+            class_id TEXT PRIMARY KEY REFERENCES courses(class_id) ON DELETE CASCADE,
+            class_name TEXT,
+            times TEXT,
+            professor TEXT
+        )
+    """)
+    await cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_interests (
+            user_id TEXT,
+            class_id TEXT REFERENCES courses(class_id) ON DELETE CASCADE,
+            channel_id TEXT,
+            PRIMARY KEY (user_id, class_id)
+        )
+    """)
+
+
+async def rebuild_table(cursor, table, definition, columns, where=''):
+    # SQLite cannot change a table's storage in place, so the table is copied into a new one and swapped in.
+    await cursor.execute(f'CREATE TABLE new_{table} ({definition}) WITHOUT ROWID')
+    await cursor.execute(f'INSERT INTO new_{table} ({columns}) SELECT {columns} FROM {table} {where}')
+    await cursor.execute(f'DROP TABLE {table}')
+    await cursor.execute(f'ALTER TABLE new_{table} RENAME TO {table}')
+
+
+async def use_without_rowid_tables(cursor):
+    # Every lookup goes through the text primary keys, so clustering rows on them saves the rowid indirection.
+    await rebuild_table(cursor, 'courses', """
+        class_id TEXT PRIMARY KEY,
+        status TEXT,
+        year_term TEXT REFERENCES term_info(year_term),
+        institution TEXT NOT NULL DEFAULT 'QNS01'
+    """, 'class_id, status, year_term, institution', 'WHERE class_id IS NOT NULL')
+    await rebuild_table(cursor, 'course_details', """
+        class_id TEXT PRIMARY KEY REFERENCES courses(class_id) ON DELETE CASCADE,
+        class_name TEXT,
+        times TEXT,
+        professor TEXT
+    """, 'class_id, class_name, times, professor', 'WHERE class_id IN (SELECT class_id FROM courses)')
+    await rebuild_table(cursor, 'user_interests', """
+        user_id TEXT NOT NULL,
+        class_id TEXT NOT NULL REFERENCES courses(class_id) ON DELETE CASCADE,
+        channel_id TEXT,
+        PRIMARY KEY (user_id, class_id)
+    """, 'user_id, class_id, channel_id', 'WHERE user_id IS NOT NULL AND class_id IN (SELECT class_id FROM courses)')
+    # The primary key already orders rows by user; this covers the per-course notification and watcher lookups.
+    await cursor.execute('CREATE INDEX IF NOT EXISTS user_interests_by_class ON user_interests (class_id, channel_id)')
+
+
+async def create_status_history_tables(cursor):
+    # Only status changes are stored, and as integers: class_id as a number, changed_at in Unix seconds
+    # and status as a code from status_history.STATUS_CODES.
+    await cursor.execute("""
+        CREATE TABLE IF NOT EXISTS status_transitions (
+            class_id INTEGER NOT NULL,
+            changed_at INTEGER NOT NULL,
+            status INTEGER NOT NULL,
+            PRIMARY KEY (class_id, changed_at)
+        ) WITHOUT ROWID
+    """)
+    await cursor.execute('CREATE INDEX IF NOT EXISTS status_transitions_by_time ON status_transitions (changed_at)')
+    # day is a proleptic Gregorian ordinal in local time.
+    await cursor.execute("""
+        CREATE TABLE IF NOT EXISTS status_daily_rollups (
+            class_id INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            open_seconds INTEGER NOT NULL,
+            flips INTEGER NOT NULL,
+            PRIMARY KEY (class_id, day)
+        ) WITHOUT ROWID
+    """)
+    # hour counts hours since the epoch. Only hours with at least one flip get a row.
+    await cursor.execute("""
+        CREATE TABLE IF NOT EXISTS status_hourly_flips (
+            class_id INTEGER NOT NULL,
+            hour INTEGER NOT NULL,
+            flips INTEGER NOT NULL,
+            PRIMARY KEY (class_id, hour)
+        ) WITHOUT ROWID
+    """)
+
+
+async def create_worker_tables(cursor):
+    await cursor.execute("""
+        CREATE TABLE IF NOT EXISTS tracker_workers (
+            worker_id TEXT PRIMARY KEY,
+            host TEXT,
+            started_at REAL NOT NULL,
+            heartbeat_at REAL NOT NULL
+        ) WITHOUT ROWID
+    """)
+    # An outbox of status changes made by tracker workers, read in order by the bot.
+    await cursor.execute("""
+        CREATE TABLE IF NOT EXISTS change_events (
+            event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            class_id TEXT NOT NULL,
+            class_name TEXT,
+            status TEXT NOT NULL,
+            worker_id TEXT,
+            created_at REAL NOT NULL
+        )
+    """)
+    await cursor.execute("""
+        CREATE TABLE IF NOT EXISTS event_cursors (
+            consumer TEXT PRIMARY KEY,
+            last_event_id INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+
+
+async def add_transition_sequence(cursor):
+    # changed_at is in whole seconds, so seq keeps two transitions of a course within the same second apart.
+    # It counts up from 0 within each (class_id, changed_at) and orders the transitions in that second.
+    await rebuild_table(cursor, 'status_transitions', """
+        class_id INTEGER NOT NULL,
+        changed_at INTEGER NOT NULL,
+        seq INTEGER NOT NULL DEFAULT 0,
+        status INTEGER NOT NULL,
+        PRIMARY KEY (class_id, changed_at, seq)
+    """, 'class_id, changed_at, status')
+    await cursor.execute('CREATE INDEX IF NOT EXISTS status_transitions_by_time ON status_transitions (changed_at)')
+
+
+# Each migration moves the schema up by one version. Append new ones; never edit one that has shipped.
+MIGRATIONS = [
+    create_base_tables,
+    use_without_rowid_tables,
+    create_status_history_tables,
+    create_worker_tables,
+    add_transition_sequence,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+async def get_schema_version(conn):
+    async with conn.execute('PRAGMA user_version') as cursor:
+        return (await cursor.fetchone())[0]
+
+
+async def migrate(conn):
+    version = await get_schema_version(conn)
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f'The database is at schema version {version}, which is newer than this code ({SCHEMA_VERSION}).')
+    if version == SCHEMA_VERSION:
+        return
+
+    await conn.commit()
+    # Table rebuilds drop tables that others reference, so foreign keys are checked once at the end instead.
+    # This pragma is a no-op inside a transaction, which is why it is set before BEGIN.
+    await conn.execute('PRAGMA foreign_keys=OFF')
+    try:
+        # All pending migrations share one transaction, so a failure leaves the database at its old version.
+        async with conn.cursor() as cursor:
+            await cursor.execute('BEGIN')
+            try:
+                for migration in MIGRATIONS[version:]:
+                    await migration(cursor)
+                await cursor.execute('PRAGMA foreign_key_check')
+                violations = await cursor.fetchall()
+                if violations:
+                    raise RuntimeError(f'Migrating left foreign key violations: {violations[:5]}')
+                await cursor.execute(f'PRAGMA user_version={SCHEMA_VERSION}')
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+        logger.info(f'Migrated the database from schema version {version} to {SCHEMA_VERSION}.')
+    finally:
+        await conn.execute('PRAGMA foreign_keys=ON')
+
+
 async def initialize_tables(conn):
     try:
-        async with conn.cursor() as cursor:    
-            await cursor.execute("""
-                CREATE TABLE IF NOT EXISTS term_info (
-                    year_term TEXT PRIMARY KEY,
-                    hidden_value TEXT,
-                    term_id TEXT
-                )
-            """)
-            await cursor.execute("""
-                CREATE TABLE IF NOT EXISTS courses (
-                    class_id TEXT PRIMARY KEY,
-                    status TEXT,
-                    year_term TEXT REFERENCES term_info(year_term)
-                )
-            """)
-            await cursor.execute("""
-                CREATE TABLE IF NOT EXISTS course_details (
-                    class_id TEXT PRIMARY KEY REFERENCES courses(class_id) ON DELETE CASCADE,
-                    class_name TEXT,
-                    times TEXT,
-                    professor TEXT
-                )
-            """)
-            await cursor.execute("""
-                CREATE TABLE IF NOT EXISTS user_interests (
-                    user_id TEXT,
-                    class_id TEXT REFERENCES courses(class_id) ON DELETE CASCADE,
-                    channel_id TEXT,
-                    PRIMARY KEY (user_id, class_id)
-                )
-            """)
-            await conn.commit()
-            logger.info("Database sucessfully initialized.")
+        await migrate(conn)
+        logger.info(f'Database sucessfully initialized at schema version {SCHEMA_VERSION}.')
     except Exception as e:
-        logger.error(f"Error occurred while initializing database: {e}")
+        logger.error(f'Error occurred while initializing database: {e}')
@@ -0,0 +1,86 @@
+import asyncio
+from contextlib import asynccontextmanager
+import aiosqlite
+import logger_utility
+
+logger = logger_utility.setup_logger(__name__, 'db_manager.log')
+
+
+class DatabaseManager:
+    def __init__(self, database='classes.db', num_readers=3, cached_statements=256, busy_timeout=5000):
+        self.database = database
+        self.num_readers = num_readers
+        self.cached_statements = cached_statements
+        self.busy_timeout = busy_timeout
+
+        self.writer_conn = None
+        self.writer_lock = asyncio.Lock()
+        self.readers = asyncio.Queue()
+        self.reader_conns = []
+        self.open_lock = asyncio.Lock()
+        self.is_open = False
+
+    async def open_connection(self):
+        # sqlite3 keeps a per-connection LRU of compiled statements, so reusing these
+        # connections means the hot queries are only prepared once.
+        conn = await aiosqlite.connect(self.database, cached_statements=self.cached_statements)
+        await conn.execute('PRAGMA journal_mode=WAL')
+        await conn.execute('PRAGMA synchronous=NORMAL')
+        await conn.execute('PRAGMA foreign_keys=ON')
+        await conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout)}')
+        return conn
+
+    async def open(self):
+        async with self.open_lock:
+            if self.is_open:
+                return
+            self.writer_conn = await self.open_connection()
+            for _ in range(self.num_readers):
+                conn = await self.open_connection()
+                self.reader_conns.append(conn)
+                self.readers.put_nowait(conn)
+            self.is_open = True
+            logger.info(f'Opened {self.database} with 1 writer and {self.num_readers} reader connections.')
+
+    async def close(self):
+        async with self.open_lock:
+            if not self.is_open:
+                return
+            self.is_open = False
+            async with self.writer_lock:
+                await self.writer_conn.close()
+                self.writer_conn = None
+            for conn in self.reader_conns:
+                await conn.close()
+            self.reader_conns.clear()
+            self.readers = asyncio.Queue()
+            logger.info(f'Closed all connections to {self.database}.')
+
+    @asynccontextmanager
+    async def writer(self):
+        if not self.is_open:
+            await self.open()
+        # Only one coroutine may use the writer at a time so that multi-statement
+        # functions in access_db cannot have their transaction committed by another task.
+        async with self.writer_lock:
+            try:
+                yield self.writer_conn
+            except Exception:
+                await self.writer_conn.rollback()
+                raise
+            # access_db functions log and swallow their errors, so one that failed partway
+            # can return normally with its transaction still open. Nothing uncommitted is
+            # left behind for the next user of the writer to commit by accident.
+            if self.writer_conn.in_transaction:
+                logger.warning('A writer was released with an uncommitted transaction. Rolling it back.')
+                await self.writer_conn.rollback()
+
+    @asynccontextmanager
+    async def reader(self):
+        if not self.is_open:
+            await self.open()
+        conn = await self.readers.get()
+        try:
+            yield conn
+        finally:
+            self.readers.put_nowait(conn)
@@ -1,13 +1,17 @@
-import random
 import os
-from dotenv import load_dotenv
+import re
 import asyncio
-import aiosqlite
+import datetime
+from dotenv import load_dotenv
 from typing import Literal
 import discord
 from discord import app_commands
 import access_db
 import global_search
+import change_stream
+import auto_enroll
+import schedule_builder
+import status_history
 import logger_utility
 
 logger = logger_utility.setup_logger(__name__, 'discord_bot.log')
@@ -19,7 +23,14 @@ class MyClient(discord.Client):
         self.tree = app_commands.CommandTree(self) 
         self.tracker = global_search.CourseTracker()
         self.course_number_range = app_commands.Range[int, 1000, 99999]
-        self.available_terms = Literal['2023 Fall Term']
+        self.available_terms = Literal['2024 Spring Term', '2024 Summer Term']
+        self.available_institutions = Literal[tuple(global_search.INSTITUTIONS.values())]
+        self.channel_cache = {}
+        # discord.py waits out per-route rate limits itself; this keeps a burst of changes from queueing hundreds of sends at once.
+        self.notification_limiter = asyncio.Semaphore(10)
+        # Changes waiting beyond this many notifications stay in the change stream, where newer ones replace older ones.
+        self.notification_workers = asyncio.Semaphore(20)
+        self.notification_tasks = set()
 
     # async def setup_hook(self):
     #     """This copies the global commands over to each guild.
@@ -32,66 +43,133 @@ class MyClient(discord.Client):
         
     async def on_ready(self):
         logger.info(f'Logged in as {self.user} (ID: {self.user.id})')
-        await start_tracking('2023 Fall Term')
+        await start_tracking()
 
 
 client = MyClient(intents=discord.Intents.default())
+institution_codes = {name: code for code, name in global_search.INSTITUTIONS.items()}
+MAX_BULK_COURSES = 25
+notification_seconds = client.tracker.metrics.histogram(
+    'discord_notification_send_seconds', 'Time taken to send one notification message, including rate limit waits.'
+)
+notifications_sent = client.tracker.metrics.counter('discord_notifications_total', 'Notification messages by outcome.', ('result',))
 
 
-async def start_tracking(term):
-    await client.tracker.initialize_db()
-    client.tracker.session = await client.tracker.create_session(term)
-    
-    while True:
-        if not client.tracker.session_active:
-            logger.info('Session is not active. Sleeping for 10 seconds.')
-            await asyncio.sleep(10)
-            continue
-        try:
-            async with aiosqlite.connect('classes.db') as conn:
-                all_courses = await access_db.fetch_all_courses(conn)
-                if not all_courses:
-                    logger.info('No courses are in the database. Sleeping for 10 seconds.')
-                    await asyncio.sleep(10)
-                    continue
-        except Exception as e:
-            logger.error(f'An error occured while trying to fetch all courses from the DB: {e}')
-            break
-            
-        params = [await client.tracker.encode_and_generate_params(class_number, year_term) for class_number, _, year_term in all_courses]
+async def start_tracking():
+    if os.getenv('METRICS_PORT'):
+        client.tracker.metrics_port = int(os.getenv('METRICS_PORT'))
+    if os.getenv('STATUS_FRESHNESS'):
+        client.tracker.status_freshness = float(os.getenv('STATUS_FRESHNESS'))
+    if os.getenv('BULK_MODE'):
+        client.tracker.bulk_mode = True
+    enrollment = start_auto_enroll()
+    try:
+        if os.getenv('TRACKER_WORKERS'):
+            # Separate `global_search.py --worker` processes do the polling; this process only delivers their changes.
+            await client.tracker.consume_change_events(notify_users)
+        else:
+            subscription = client.tracker.changes.subscribe('discord_bot', policy=change_stream.COALESCE)
+            delivery = asyncio.create_task(deliver_changes(subscription))
+            try:
+                await client.tracker.start_tracking()
+            finally:
+                delivery.cancel()
+    finally:
+        if enrollment:
+            enrollment.cancel()
+        await client.tracker.close()
+
+
+def start_auto_enroll():
+    # Opt in by pointing AUTO_ENROLL_FILE at a JSON list of targets; see auto_enroll.load_targets.
+    if not os.getenv('AUTO_ENROLL_FILE'):
+        return None
+    targets = auto_enroll.load_targets(os.getenv('AUTO_ENROLL_FILE'))
+    builder = schedule_builder.ScheduleBuilderClient(client.tracker.db, registry=client.tracker.metrics)
+    pipeline = auto_enroll.EnrollPipeline(client.tracker, builder, targets)
+    return asyncio.create_task(pipeline.run())
+
+
+async def deliver_changes(subscription):
+    async for event in subscription:
+        await client.notification_workers.acquire()
+        task = asyncio.create_task(notify_users(event.class_name, event.class_id, event.status))
+        client.notification_tasks.add(task)
+        task.add_done_callback(finish_notification)
+
+
+def finish_notification(task):
+    client.notification_tasks.discard(task)
+    client.notification_workers.release()
+
+
+def build_notification_messages(user_ids, text, limit=2000):
+    """Mentions every user ahead of text, split into as few messages as fit under Discord's length limit."""
+    messages = []
+    mentions = []
+    length = len(text)
+    for user_id in user_ids:
+        mention = f'<@{user_id}>'
+        if mentions and length + len(mention) + 1 > limit:
+            messages.append(' '.join(mentions) + text)
+            mentions = []
+            length = len(text)
+        mentions.append(mention)
+        length += len(mention) + 1
+    if mentions:
+        messages.append(' '.join(mentions) + text)
+    return messages
+
+
+async def resolve_channel(channel_id):
+    channel = client.channel_cache.get(channel_id) or client.get_channel(channel_id)
+    if not channel:
         try:
-            async with aiosqlite.connect('classes.db') as conn:
-                tasks = [client.tracker.sync_status_with_db(client.tracker.session, conn, param) for param in params]
-                for task in asyncio.as_completed(tasks):
-                    completed_task = await task
-                    if completed_task:
-                        class_name, class_id, class_status, status_changed = completed_task
-                        if status_changed:
-                            await notify_users(class_name, class_id, class_status)
-                        print(f'{class_name}-{class_id}: {class_status}')
-                    else:
-                        logger.error('An error occured when trying to sync webpage status with DB: No results.')
-                    await asyncio.sleep(round(random.uniform(0.05, 0.2), 2))
-                await asyncio.sleep(round(random.uniform(2.66, 4.66), 2))
-        except Exception as e:
-            logger.error(f'An error occurred: {e}\nTrying to recreate session in {client.tracker.wait_time} seconds.')
-            client.tracker.session_active = False
-            await client.tracker.session.aclose()
-            client.tracker.session = await client.tracker.create_session(term)
-    await client.tracker.session.aclose()
+            channel = await client.fetch_channel(channel_id)
+        except discord.HTTPException as e:
+            logger.warning(f'Unable to fetch channel {channel_id}: {e}')
+            return None
+    client.channel_cache[channel_id] = channel
+    return channel
+
+
+async def notify_channel(channel_id, user_ids, class_name, course_number, status):
+    channel = await resolve_channel(channel_id)
+    if not channel:
+        logger.warning(f'Error: Unable to send notification for {class_name}. Users were {user_ids} and Channel was {channel_id}.')
+        return
+    for message in build_notification_messages(user_ids, f', {class_name}-{course_number} is now {status}!'):
+        async with client.notification_limiter:
+            try:
+                with notification_seconds.time():
+                    await channel.send(message)
+                notifications_sent.inc(result='sent')
+            except (discord.NotFound, discord.Forbidden):
+                notifications_sent.inc(result='failed')
+                client.channel_cache.pop(channel_id, None)
+                raise
+            except Exception:
+                notifications_sent.inc(result='failed')
+                raise
+    logger.info(f'Notified {len(user_ids)} users in {channel} about {class_name}-{course_number} being {status}.')
+
 
 async def notify_users(class_name, course_number, status):
     try:
-        async with aiosqlite.connect('classes.db') as conn:
+        async with client.tracker.db.reader() as conn:
             user_channel_tuples = await access_db.fetch_all_users_and_channels_for_course(conn, course_number)
-            for user_id, channel_id in user_channel_tuples:
-                channel = client.get_channel(int(channel_id)) or await client.fetch_channel(int(channel_id))
-                if channel:
-                    print(f'Notified {user_id} in {channel} about {class_name}-{course_number} being {status}.')
-                    await channel.send(f'<@{user_id}>, {class_name}-{course_number} is now {status}!')
-                else:
-                    logger.warning(f'Error: Unable to send notification for {class_name}. User was {user_id} and Channel was {channel}.')
-                    
+        users_by_channel = {}
+        for user_id, channel_id in user_channel_tuples:
+            users_by_channel.setdefault(int(channel_id), []).append(user_id)
+
+        # One message per channel, with different channels sent concurrently.
+        results = await asyncio.gather(*(
+            notify_channel(channel_id, user_ids, class_name, course_number, status)
+            for channel_id, user_ids in users_by_channel.items()
+        ), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f'An error occured when trying to notify a channel about {class_name}-{course_number}: {result}')
     except Exception as e:
         logger.error(f'An error occured when trying to notify users about a status change: {e}')
 
@@ -101,13 +179,12 @@ async def notify_users(class_name, course_number, status):
 async def get_course_info(interaction: discord.Interaction, course_number: client.course_number_range):
     """Retreives basic information about a course saved on the database."""
     try:
-        async with aiosqlite.connect('classes.db') as conn:
-            course_tuple = await access_db.get_course_with_details_row(conn, str(course_number))
-            if course_tuple:
-                class_id, status, term, class_name, times, professor = course_tuple
-                await interaction.response.send_message(f'{class_name}-{class_id}: {status}\n{term}\nProfessor: {professor}\nTimes: {times}')
-            else:
-                await interaction.response.send_message('That course is not in the database.', ephemeral=True)
+        course_tuple = await client.tracker.get_course_info(str(course_number))
+        if course_tuple:
+            class_id, status, term, class_name, times, professor = course_tuple
+            await interaction.response.send_message(f'{class_name}-{class_id}: {status}\n{term}\nProfessor: {professor}\nTimes: {times}')
+        else:
+            await interaction.response.send_message('That course is not in the database.', ephemeral=True)
     except Exception as e:
         logger.error(f'An error occured when trying to get course information on {course_number}: {e}')
         await interaction.response.send_message(f'An error occurred: {e}', ephemeral=True)        
@@ -115,58 +192,75 @@ async def get_course_info(interaction: discord.Interaction, course_number: clien
 
 @client.tree.command()
 @app_commands.describe(course_number='Unique Class Number that can be found on Schedule Builder or Global Search')
-async def check_course_status(interaction: discord.Interaction, course_number: client.course_number_range, term: client.available_terms):
+async def check_course_status(interaction: discord.Interaction, course_number: client.course_number_range, term: client.available_terms,
+                              institution: client.available_institutions = 'Queens College'):
     """Checks CUNY Global Search webpage for real-time course status."""
     try:
-        response = await client.tracker.scrape_webpage_status(
-            client.tracker.session, params=await client.tracker.encode_and_generate_params(str(course_number), term)
-        )
+        response = await client.tracker.check_status(str(course_number), term, institution_codes[institution])
         if not response:
             raise ValueError(f'Response was empty when trying to check course status.')
         
-        class_name, class_id, status = response
+        class_name, class_id, status, age = response
         if str(course_number) != class_id:
             raise ValueError('Course number did not match when checking the website.')
-        await interaction.response.send_message(f'{class_name}-{class_id}: {status}')
+        await interaction.response.send_message(f'{class_name}-{class_id}: {status} (checked {format_age(age)})')
     except Exception as e:
         logger.error(f'An error occured while attempting to check the status of {course_number}: {e}')
         await interaction.response.send_message(f'An error occurred: {e}', ephemeral=True)
 
 
+def format_age(seconds):
+    if seconds < 1:
+        return 'just now'
+    return f'{seconds:.0f} seconds ago' if seconds < 120 else f'{seconds // 60:.0f} minutes ago'
+
+
 @client.tree.command()
 @app_commands.describe(course_number='Unique Class Number that can be found on Schedule Builder or Global Search')
-async def add_course(interaction: discord.Interaction, course_number: client.course_number_range, term: client.available_terms):
+async def add_course(interaction: discord.Interaction, course_number: client.course_number_range, term: client.available_terms,
+                     institution: client.available_institutions = 'Queens College'):
     """Adds a course to be tracked by the bot."""
-    database_value = None
-    async with aiosqlite.connect('classes.db') as conn:    
-        try:
-            database_value = await access_db.get_course_name_and_status(conn, str(course_number))
-        except Exception as e:
-            logger.error(f'An error occured while trying access the DB to add a new course: {e}')
-            await interaction.response.send_message(f'An error occurred: {e}', ephemeral=True)
+    try:
+        added = await client.tracker.add_courses([str(course_number)], term, institution_codes[institution],
+                                                 interaction.user.id, interaction.channel.id)
+        if str(course_number) not in added:
+            logger.error(f'Could not add {course_number} for {interaction.user.id}.')
+            await interaction.response.send_message(f'An error occurred: the webpage returned nothing.', ephemeral=True)
             return
+        class_name, status, _, _ = added[str(course_number)]
+        await interaction.response.send_message(f'{class_name}-{course_number}: {status}')
+    except Exception as e:
+        logger.error(f'An error occured while trying to add a course: {e}')
+        await interaction.response.send_message(f'An error occurred: {e}', ephemeral=True)
 
-        if database_value: 
-            try:
-                await access_db.add_user_interest(conn, (interaction.user.id, str(course_number), interaction.channel.id))
-                class_name, status = database_value
-                await interaction.response.send_message(f'{class_name}-{course_number}: {status}')
-            except Exception as e:
-                logger.error(f'An error occured while trying to add a new user interest: {e}')
-                await interaction.response.send_message(f'An error occurred: {e}', ephemeral=True)
-        else: # This means we have to create a new database entry for the course requested. 
-            try:
-                response = await client.tracker.add_new_course_to_db(client.tracker.session, conn, str(course_number), term)
-                if response:
-                    class_name, status, _, _ = response
-                    await access_db.add_user_interest(conn, (interaction.user.id, str(course_number), interaction.channel.id))
-                    await interaction.response.send_message(f'{class_name}-{course_number}: {status}')
-                else:
-                    logger.error('Got None as response while trying to add a new course to the DB')
-                    await interaction.response.send_message(f'An error occurred: the webpage returned nothing.', ephemeral=True)
-            except Exception as e:
-                logger.error(f'An error occured while trying to add a new entry to the DB: {e}')
-                await interaction.response.send_message(f'An error occurred: {e}', ephemeral=True)
+
+@client.tree.command()
+@app_commands.describe(course_numbers=f'Unique Class Numbers separated by spaces or commas, up to {MAX_BULK_COURSES} at once')
+async def add_courses(interaction: discord.Interaction, course_numbers: str, term: client.available_terms,
+                      institution: client.available_institutions = 'Queens College'):
+    """Adds several courses to be tracked by the bot at once."""
+    numbers = list(dict.fromkeys(re.findall(r'\d+', course_numbers)))
+    invalid = [number for number in numbers if not 1000 <= int(number) <= 99999]
+    if not numbers or invalid or len(numbers) > MAX_BULK_COURSES:
+        await interaction.response.send_message(
+            f'Give between 1 and {MAX_BULK_COURSES} class numbers from 1000 to 99999.' + (f' These are not: {", ".join(invalid)}' if invalid else ''),
+            ephemeral=True
+        )
+        return
+
+    # New courses have to be scraped first, which can take longer than Discord waits for a reply.
+    await interaction.response.defer(thinking=True)
+    try:
+        added = await client.tracker.add_courses(numbers, term, institution_codes[institution], interaction.user.id, interaction.channel.id)
+    except Exception as e:
+        logger.error(f'An error occured while trying to add {numbers}: {e}')
+        await interaction.followup.send(f'An error occurred: {e}', ephemeral=True)
+        return
+    lines = [f'{class_name}-{class_id}: {status}' for class_id, (class_name, status, _, _) in added.items()]
+    failed = [number for number in numbers if number not in added]
+    if failed:
+        lines.append(f'Could not add {", ".join(failed)}.')
+    await interaction.followup.send('\n'.join(lines))
 
 
 @client.tree.command()
@@ -176,16 +270,20 @@ async def remove_course(interaction: discord.Interaction, course_number: client.
     deleted_rows = 0
     class_name = None
     try:
-        async with aiosqlite.connect('classes.db') as conn:
-            class_name, _ = await access_db.get_course_name_and_status(conn, course_number)
+        course_tuple = await client.tracker.get_course_info(str(course_number))
+        if course_tuple:
+            class_name = course_tuple[3]
+        async with client.tracker.db.writer() as conn:
             deleted_rows = await access_db.remove_user_interest(conn, interaction.user.id, str(course_number))
             if deleted_rows is None:
                 raise ValueError('Got None instead of an integer for deleted rows.')
+        client.tracker.cache.invalidate_user(interaction.user.id)
     except Exception as e:
         logger.error(f'An error occured while accessing the DB to remove a course: {e}')
         await interaction.response.send_message(f'An error occured: {e}', ephemeral=True)
         return
     if deleted_rows < 0:
+        client.tracker.untrack_course(str(course_number))
         await interaction.response.send_message(f'Removed {class_name}-{course_number} from your tracked courses.\n'
             'No one else was tracking this course, so it was removed from the database.'
         )
@@ -199,16 +297,14 @@ async def remove_course(interaction: discord.Interaction, course_number: client.
 async def fetch_all_tracked_courses(interaction: discord.Interaction):
     """Returns a list of ALL courses currently being tracked by the bot."""
     try:
-        async with aiosqlite.connect('classes.db') as conn:
-            courses = await access_db.fetch_all_courses(conn)
-            if courses:
-                message = ''
-                for class_id, _, _ in courses:
-                    class_name, status = await access_db.get_course_name_and_status(conn, class_id)
-                    message += f'{class_name}-{class_id}: {status}\n'
-                await interaction.response.send_message(message)
-            else:
-                await interaction.response.send_message('No courses are currently being tracked.', ephemeral=True)
+        courses = await client.tracker.get_all_tracked_courses()
+        if courses:
+            message = ''
+            for class_id, (class_name, status) in courses:
+                message += f'{class_name}-{class_id}: {status}\n'
+            await interaction.response.send_message(message)
+        else:
+            await interaction.response.send_message('No courses are currently being tracked.', ephemeral=True)
     except Exception as e:
         logger.error(f'An error occured while trying to retrieve all courses in the DB: {e}')
         await interaction.response.send_message(f'An error occured: {e}', ephemeral=True)     
@@ -218,20 +314,103 @@ async def fetch_all_tracked_courses(interaction: discord.Interaction):
 async def get_my_tracked_courses(interaction: discord.Interaction):
     """Returns a list of courses YOU have requested to be notified about."""
     try:
-        async with aiosqlite.connect('classes.db') as conn:
-            class_ids = await access_db.fetch_user_interests(conn, interaction.user.id)
-            if class_ids:
-                message = ''
-                for class_id in class_ids:
-                    class_name, status = await access_db.get_course_name_and_status(conn, class_id)
-                    message += f'{class_name}-{class_id}: {status}\n'
-                await interaction.response.send_message(message)
-            else:
-                await interaction.response.send_message('No courses are currently being tracked.', ephemeral=True)
+        courses = await client.tracker.get_user_tracked_courses(interaction.user.id)
+        if courses:
+            message = ''
+            for class_id, class_name, status in courses:
+                message += f'{class_name}-{class_id}: {status}\n'
+            await interaction.response.send_message(message)
+        else:
+            await interaction.response.send_message('No courses are currently being tracked.', ephemeral=True)
     except Exception as e:
         logger.error(f"An error occured while trying to access {interaction.user.name}'s tracked courses: {e}")
         await interaction.response.send_message(f'An error occured: {e}', ephemeral=True) 
 
 
-load_dotenv()
-client.run(os.getenv('DISCORD_TOKEN'))
\ No newline at end of file
+
+def format_duration(seconds):
+    hours, minutes = divmod(seconds // 60, 60)
+    return f'{hours}h {minutes:02d}m'
+
+
+@client.tree.command()
+@app_commands.describe(course_number='Unique Class Number that can be found on Schedule Builder or Global Search',
+                       days='How many days back to look, including today')
+async def course_history(interaction: discord.Interaction, course_number: client.course_number_range,
+                         days: app_commands.Range[int, 1, 30] = 7):
+    """Shows how long a course has been open each day and how often its status changed."""
+    try:
+        course_tuple = await client.tracker.get_course_info(str(course_number))
+        class_name = course_tuple[3] if course_tuple else 'Course'
+        daily, hourly, last_transition = await client.tracker.get_course_history(str(course_number), days)
+        if not daily:
+            await interaction.response.send_message('There is no status history for that course yet.', ephemeral=True)
+            return
+
+        lines = [f'{class_name}-{course_number} over the last {days} days:']
+        for day, open_seconds, flips in daily:
+            date = datetime.date.fromordinal(day)
+            lines.append(f'{date:%a %b} {date.day}: open {format_duration(open_seconds)}, {flips} status changes')
+        total_flips = sum(flips for _, _, flips in daily)
+        if hourly:
+            flips_by_hour = {}
+            for hour, flips in hourly:
+                local_hour = status_history.local_hour(hour)
+                flips_by_hour[local_hour] = flips_by_hour.get(local_hour, 0) + flips
+            busiest_hour = max(flips_by_hour, key=flips_by_hour.get)
+            lines.append(f'{total_flips} changes in total, most often around {busiest_hour % 12 or 12} {"AM" if busiest_hour < 12 else "PM"}.')
+        if last_transition:
+            changed_at, status = last_transition
+            lines.append(f'{status_history.decode_status(status)} since <t:{changed_at}:R>.')
+        await interaction.response.send_message('\n'.join(lines))
+    except Exception as e:
+        logger.error(f'An error occured while trying to get the status history of {course_number}: {e}')
+        await interaction.response.send_message(f'An error occured: {e}', ephemeral=True)
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return '-'
+    if seconds == float('inf'):
+        return 'over the largest bucket'
+    return f'{seconds * 1000:.0f} ms' if seconds < 1 else f'{seconds:.1f} s'
+
+
+@client.tree.command()
+@app_commands.default_permissions(administrator=True)
+@app_commands.checks.has_permissions(administrator=True)
+async def tracker_stats(interaction: discord.Interaction):
+    """Shows how the tracker is performing. Only server administrators can use this."""
+    try:
+        stats = client.tracker.get_stats()
+        polls = ', '.join(f'{count} {result}' for result, count in sorted(stats['polls'].items())) or 'none yet'
+        errors = ', '.join(f'{count} {error}' for error, count in sorted(stats['errors'].items(), key=lambda item: -item[1])) or 'none'
+        message = (
+            f'Tracking {stats["courses"]} courses at up to {stats["request_rate"]:.2f} requests per second.\n'
+            f'Polls: {polls}\n'
+            f'Request latency: p50 {format_seconds(stats["request_p50"])}, p95 {format_seconds(stats["request_p95"])}\n'
+            f'Parse p95: {format_seconds(stats["parse_p95"])}. Status flush p95: {format_seconds(stats["flush_p95"])}\n'
+            f'Sweeps: {stats["sweeps"]} (p50 {format_seconds(stats["sweep_p50"])}, last covered {stats["last_sweep_courses"]} courses '
+            f'in {stats["last_sweep_polls"]} polls)\n'
+            f'Notification send p95: {format_seconds(notification_seconds.quantile(0.95))}\n'
+            f'Session recreations: {stats["session_recreations"]}\n'
+            f'Errors: {errors}\n'
+            f'Unchanged pages skipped: {stats["fingerprint_hit_rate"]:.0%}. Command cache hits: {stats["cache_hit_rate"]:.0%}'
+        )
+        await interaction.response.send_message(message, ephemeral=True)
+    except Exception as e:
+        logger.error(f'An error occured while trying to collect tracker stats: {e}')
+        await interaction.response.send_message(f'An error occured: {e}', ephemeral=True)
+
+
+@tracker_stats.error
+async def tracker_stats_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
+    if isinstance(error, app_commands.MissingPermissions):
+        await interaction.response.send_message('Only server administrators can view tracker stats.', ephemeral=True)
+    else:
+        logger.error(f'An error occured in tracker_stats: {error}')
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    client.run(os.getenv('DISCORD_TOKEN'))
@@ -1,205 +1,924 @@
-import re
+import os
+import time
 import base64
-import random
+import socket
 import asyncio
-import aiosqlite
-import httpx
-from bs4 import BeautifulSoup
+import argparse
+from collections import defaultdict
 import create_db
 import access_db
+import db_manager
+import course_parser
+import course_cache
+import change_stream
+import status_history
+import sharding
+import tracker_snapshot
+import metrics
+import parse_executor
+import poll_scheduler
+import rate_governor
+import session_pool
 import logger_utility
 
 logger = logger_utility.setup_logger(__name__, 'global_search.log')
+# Every poll reports its status, so only a sample of those lines is logged, and only at DEBUG.
+poll_logger = logger_utility.SampledLogger(logger)
+
+INSTITUTIONS = {
+    'BAR01': 'Baruch College',
+    'BMC01': 'Borough of Manhattan CC',
+    'BCC01': 'Bronx CC',
+    'BKL01': 'Brooklyn College',
+    'CTY01': 'City College',
+    'CSI01': 'College of Staten Island',
+    'GRD01': 'Graduate Center',
+    'NCC01': 'Guttman CC',
+    'HOS01': 'Hostos CC',
+    'HTR01': 'Hunter College',
+    'JJC01': 'John Jay College',
+    'KCC01': 'Kingsborough CC',
+    'LAG01': 'LaGuardia CC',
+    'LEH01': 'Lehman College',
+    'MEC01': 'Medgar Evers College',
+    'NYT01': 'NYC College of Technology',
+    'QNS01': 'Queens College',
+    'QCC01': 'Queensborough CC',
+    'SPS01': 'School of Professional Studies',
+    'YRK01': 'York College'
+}
+
+CAREERS = {
+    'UGRD': 'Undergraduate',
+    'GRAD': 'Graduate'
+}
 
 
 class CourseTracker:
-    def __init__(self):
+    def __init__(self, parse_executor_kind='thread', parse_workers=2, max_pending_parses=8, requests_per_second=2.0,
+                 burst=4, num_sessions=3, http2=False, bulk_mode=False, bulk_threshold=3, bulk_career='UGRD',
+                 database='classes.db', search_url=session_pool.GLOBAL_SEARCH_URL, metrics_port=None, worker_id=None,
+                 snapshot_path=None):
+        self.db = db_manager.DatabaseManager(database)
+        # With a worker_id this tracker polls only its share of the courses and publishes changes to change_events.
+        self.worker_id = worker_id
+        self.coordinator = sharding.ShardCoordinator(self.db, worker_id) if worker_id else None
+        # False once consume_change_events takes over: the workers own every status, and this process only reads them.
+        self.polling = True
         self.all_terms = None
         self.wait_time = 10
+
+        self.courses = {}
+        self.pending_status_updates = {}
+        self.flush_interval = 0.5
+        self.last_flush = time.monotonic()
+        self.pending_transitions = []
+        self.history_rollup_interval = 900
+        self.last_history_rollup = 0
+        self.history_retention_days = 90
+
+        # Runtime state is snapshotted now and then so a restart can resume polling without starting over.
+        if snapshot_path is None:
+            snapshot_path = os.path.splitext(database)[0] + (f'-{worker_id}' if worker_id else '') + '.snapshot'
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = 60
+        self.snapshot_max_age = 900
+        self.last_snapshot = time.monotonic()
+        self.tracking_started = False
+
+        self.governor = rate_governor.RateGovernor(rate=requests_per_second, burst=burst)
+        self.scheduler = poll_scheduler.PollScheduler(requests_per_second=requests_per_second)
+        self.watcher_refresh_interval = 60
+        self.last_watcher_refresh = 0
+        self.max_in_flight = asyncio.BoundedSemaphore(8)
+        self.poll_tasks = set()
         
-        self.semaphore = asyncio.BoundedSemaphore(2)
-        self.session = None
-        self.session_lock = asyncio.Lock()
-        self.session_active = False
+        self.bulk_mode = bulk_mode
+        self.bulk_threshold = bulk_threshold
+        self.bulk_career = bulk_career
+        self.subject_groups = defaultdict(set)
+        self.bulk_unresolved = set()
+
+        self.search_url = search_url
+        self.num_sessions = num_sessions
+        self.http2 = http2
+        self.partitions = {}
         
-        self.payload = None
+        self.verify_parser = False
+        self.fingerprints = course_parser.FingerprintCache()
+        self.new_entry_scrapes = {}
+        # Live status checks are answered from the last poll when it is at most status_freshness seconds old.
+        self.status_freshness = 30
+        self.observed_at = {}
+        self.live_checks = {}
+        self.cache = course_cache.CourseCache()
+        self.parse_executor = parse_executor.ParseExecutor(parse_executor_kind, parse_workers, max_pending_parses)
         self.headers = {'User-Agent':
             'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36'
         }
 
+        self.metrics = metrics.MetricsRegistry()
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.parse_seconds = self.metrics.histogram(
+            'tracker_parse_seconds', 'Time taken to parse a page, including waiting for a parse worker.', ('page',), metrics.PARSE_BUCKETS
+        )
+        self.db_seconds = self.metrics.histogram('tracker_db_seconds', 'Time taken by database operations.', ('operation',), metrics.DB_BUCKETS)
+        self.sweep_seconds = self.metrics.histogram(
+            'tracker_sweep_seconds', 'Time taken to poll every tracked course at least once.', buckets=metrics.SWEEP_BUCKETS
+        )
+        self.sweep_courses = self.metrics.gauge('tracker_sweep_courses', 'Courses covered by the last completed sweep.')
+        self.sweep_polls = self.metrics.gauge('tracker_sweep_polls', 'Polls made during the last completed sweep.')
+        self.polls = self.metrics.counter('tracker_polls_total', 'Course polls by outcome.', ('result',))
+        self.status_checks = self.metrics.counter(
+            'tracker_status_checks_total', 'Status checks by where the answer came from: the last poll, a live request, or another check\'s request.',
+            ('source',)
+        )
+        self.errors = self.metrics.counter('tracker_errors_total', 'Errors caught by the tracker, by exception type.', ('type',))
+        self.metrics.gauge('tracker_courses', 'Courses currently tracked.', func=lambda: len(self.courses))
+        self.metrics.gauge('tracker_polls_in_flight', 'Polls currently running.', func=lambda: len(self.poll_tasks))
+        self.metrics.gauge('tracker_request_rate', 'Requests per second currently allowed by the rate governor.',
+                           func=lambda: self.governor.current_rate)
+        self.metrics.gauge('tracker_fingerprint_hit_rate', 'Share of class pages that skipped parsing.', func=lambda: self.fingerprints.hit_rate)
+        self.metrics.gauge('tracker_cache_hit_rate', 'Share of command lookups answered from the cache.', func=lambda: self.cache.hit_rate)
+        self.sweep_started = time.monotonic()
+        self.swept = set()
+        self.polls_this_sweep = 0
+        # Consumers subscribe here instead of running inside the poll tasks, so they can never slow polling down.
+        self.changes = change_stream.ChangeStream(self.metrics)
+
     async def initialize_db(self):
-        async with aiosqlite.connect('classes.db') as conn:
+        await self.db.open()
+        async with self.db.writer() as conn:
             await create_db.initialize_tables(conn)
             await access_db.add_term_info(conn, ('2024 Spring Term', '1242', '3202330'))
             await access_db.add_term_info(conn, ('2024 Summer Term', '1246', '3202420'))
             # This is hard coded for now until I update the code to automatically find this information.
     
-    async def create_payload(self, term):
+    async def load_terms(self):
+        async with self.db.reader() as conn:
+            self.all_terms = {year_term: hidden_value for year_term, hidden_value, _ in await access_db.fetch_all_terms(conn)}
+
+    async def create_payload(self, term, institution):
+        if self.all_terms is None or term not in self.all_terms:
+            await self.load_terms()
+        if term not in self.all_terms:
+            raise ValueError(f'No row found in term_info for term {term}')
+        if institution not in INSTITUTIONS:
+            raise ValueError(f'Unknown institution code {institution}')
+        return {
+            'selectedInstName': f'{INSTITUTIONS[institution]} | ',
+            'inst_selection': institution,
+            'selectedTermName': term,
+            'term_value': self.all_terms[term],
+            'next_btn': 'Next'
+        }
+
+    async def start_partition(self, institution, term, restored=()):
+        payload = await self.create_payload(term, institution)
+        sessions = session_pool.SessionPool(
+            payload, self.headers, self.governor, size=self.num_sessions, http2=self.http2, wait_time=self.wait_time,
+            url=self.search_url, registry=self.metrics
+        )
+        await sessions.start(restored)
+        logger.info(f'Started a session partition for {INSTITUTIONS[institution]} {term}.')
+        return sessions
+
+    async def get_partition(self, institution, term, restored=()):
+        # Global Search keeps the selected institution and term in the session, so every
+        # (institution, term) pair needs sessions of its own. Concurrent callers share one start-up.
+        key = (institution, term)
+        if key not in self.partitions:
+            self.partitions[key] = asyncio.create_task(self.start_partition(institution, term, restored))
         try:
-            async with aiosqlite.connect('classes.db') as conn:
-                self.all_terms = {year_term: hidden_value for year_term, hidden_value, _ in await access_db.fetch_all_terms(conn)}
-                if term in self.all_terms:
-                    return {
-                        'selectedInstName': 'Queens College | ',
-                        'inst_selection': 'QNS01',
-                        'selectedTermName': term,
-                        'term_value': self.all_terms[term],
-                        'next_btn': 'Next'
-                    }
-                raise ValueError(f'No row found in term_info for term {term}')
-        except Exception as e:
-            logger.error(f'An error occured while trying to create payload: {e}')
-            exit(1)
-    
-    async def create_session(self, term):
-        async with self.session_lock:
-            if not self.payload:
-                self.payload = await self.create_payload(term)
-            
-            while True:
-                try:
-                    session = httpx.AsyncClient(headers=self.headers)
-                    response = await session.post('https://globalsearch.cuny.edu/CFGlobalSearchTool/CFSearchToolController', data=self.payload)
-                    response.raise_for_status()
-                    self.session_active = True
-                    return session
-                except Exception as e:
-                    self.session_active = False
-                    logger.error(f'An error occured while creating a new session: {e}\nTrying again in {self.wait_time} seconds.')
-                    await asyncio.sleep(self.wait_time)
+            return await asyncio.shield(self.partitions[key])
+        except Exception:
+            self.partitions.pop(key, None)
+            raise
     
-    async def encode_and_generate_params(self, class_id, term):
+    async def encode_and_generate_params(self, class_id, term, institution='QNS01'):
         encoded_class_number = base64.b64encode(class_id.encode()).decode()
         encoded_term = base64.b64encode(self.all_terms[term].encode()).decode()
         return {
             'class_number_searched': encoded_class_number,
             'session_searched': 'MQ==', # Hard coded '1'
             'term_searched': encoded_term,
-            'inst_searched': 'UXVlZW5zIENvbGxlZ2U=' # Hard coded 'Queens College'
+            'inst_searched': base64.b64encode(INSTITUTIONS[institution].encode()).decode()
         }
 
-    async def scrape_for_new_entry(self, session, class_id, term):
-        async with self.semaphore:
-            params = await self.encode_and_generate_params(class_id, term)
-            try:
-                response = await session.get('https://globalsearch.cuny.edu/CFGlobalSearchTool/CFSearchToolController', params=params)
-                response.raise_for_status()
-                soup = BeautifulSoup(response.text, 'lxml')
-                
-                error_message = soup.find('h1')
-                if error_message and 'Oops' in error_message.text:
-                    raise ValueError('The class does not exist.')
-                webpage_class_id = soup.find('td', string=re.compile('\d+')).get_text(strip=True)
-                if class_id != webpage_class_id:
-                    raise ValueError('The webpage class number does not match the request.')
-                
-                full_class_name = soup.find('div', {'class': 'shadowbox'}).find('p').get_text(strip=True)
-                class_name = re.search(r'\b[A-Z]+\s\d+', full_class_name).group()
-                status = soup.find('img', alt=['Open', 'Close'])['alt']
-                time = soup.find('td', {'data-label': 'Days And Times'}).get_text(strip=True)
-                professor = soup.find('td', {'data-label': 'Instructor'}).get_text(strip=True)
-                return (class_name, status, time, professor)
-            except Exception as e:
-                logger.error(f'An error occured while trying to scrape for a new entry: {e}')
-                return None
-    
-    async def add_new_course_to_db(self, session, conn, class_id, term):
-        result = await self.scrape_for_new_entry(session, class_id, term)
-        if not result:
-            logger.error('An error occured while scraping the webpage. Cannot add course.')
+    async def fetch_class_page(self, class_id, term, institution):
+        sessions = await self.get_partition(institution, term)
+        # An Oops page for a tracked class is more likely a lapsed session than a cancelled section, so it is checked
+        # on a second session. For a class being looked up for the first time it usually just means a mistyped number.
+        ambiguous = course_parser.is_oops_page if class_id in self.courses else None
+        params = await self.encode_and_generate_params(class_id, term, institution)
+        response = await sessions.get(params, course_parser.class_page_problem, ambiguous)
+        return response.content
+
+    def generate_search_payload(self, subject, career):
+        # Mirrors the Search Criteria form with only subject and career filled in, so closed sections are listed too.
+        return {
+            'selectedSubjectName': subject,
+            'subject_name': subject,
+            'selectedCCareerName': CAREERS[career],
+            'courseCareer': career,
+            'selectedCAttrName': '',
+            'courseAttr': '',
+            'selectedCAttrVName': '',
+            'courseAttValue': '',
+            'selectedReqDName': '',
+            'reqDesignation': '',
+            'selectedSessionName': '',
+            'class_session': '',
+            'selectedModeInsName': '',
+            'meetingStart': 'LT',
+            'meetingStartText': '',
+            'meetingEnd': 'LE',
+            'meetingEndText': '',
+            'daysOfWeek': 'I',
+            'instructor': 'B',
+            'instructorName': '',
+            'search_btn_search': 'Search'
+        }
+
+    async def fetch_results_listing(self, institution, term, subject, career):
+        sessions = await self.get_partition(institution, term)
+        response = await sessions.post(self.generate_search_payload(subject, career), course_parser.listing_page_problem)
+        return response.content
+
+    async def parse_class_page(self, content):
+        with self.parse_seconds.time(page='class'):
+            return await self.parse_executor.run(course_parser.extract_class_page, content, verify=self.verify_parser)
+
+    def record_error(self, error):
+        self.errors.inc(type=type(error).__name__)
+
+    async def scrape_for_new_entry(self, class_id, term, institution='QNS01'):
+        try:
+            content = await self.fetch_class_page(class_id, term, institution)
+            webpage_class_id, class_name, status, times, professor = await self.parse_class_page(content)
+            if class_id != webpage_class_id:
+                raise ValueError('The webpage class number does not match the request.')
+            if not times or not professor:
+                raise ValueError('Failed to find the days and times or instructor in the HTML.')
+            return (class_name, status, times, professor)
+        except Exception as e:
+            self.record_error(e)
+            logger.error(f'An error occured while trying to scrape for a new entry: {e}')
             return None
-        
-        class_name, status, time, professor = result
+    
+    async def scrape_new_entry_once(self, class_id, term, institution='QNS01'):
+        # Concurrent adds of the same new course share one scrape instead of each fetching the page.
+        key = (institution, term, class_id)
+        if key not in self.new_entry_scrapes:
+            task = asyncio.create_task(self.scrape_for_new_entry(class_id, term, institution))
+            self.new_entry_scrapes[key] = task
+            task.add_done_callback(lambda _: self.new_entry_scrapes.pop(key, None))
+        return await asyncio.shield(self.new_entry_scrapes[key])
+
+    async def add_courses(self, class_ids, term, institution='QNS01', user_id=None, channel_id=None):
+        """Adds class_ids, and the user's interest in each when user_id is given, in one transaction.
+
+        Courses that are not tracked yet are scraped concurrently, within the rate governor's limits.
+        Returns {class_id: (class_name, status, times, professor)} for every course that is tracked afterwards."""
+        class_ids = list(dict.fromkeys(class_ids))
+        known = {}
+        for class_id in class_ids:
+            row = await self.get_course_info(class_id)
+            if row:
+                known[class_id] = (row[3], row[1], row[4], row[5])
+        unknown = [class_id for class_id in class_ids if class_id not in known]
+        scraped = await asyncio.gather(*(self.scrape_new_entry_once(class_id, term, institution) for class_id in unknown))
+        new = {class_id: result for class_id, result in zip(unknown, scraped) if result}
+        if len(new) < len(unknown):
+            logger.error(f'Could not scrape {[class_id for class_id in unknown if class_id not in new]}. Cannot add them.')
+        added = {**known, **new}
+        if not added:
+            return {}
+
+        interests = [(user_id, class_id, channel_id) for class_id in added] if user_id is not None else []
+        try:
+            with self.db_seconds.time(operation='add_courses'):
+                async with self.db.writer() as conn:
+                    saved = await access_db.add_courses_with_interests(
+                        conn,
+                        [(class_id, status, term, institution) for class_id, (_, status, _, _) in new.items()],
+                        [(class_id, class_name, times, professor) for class_id, (class_name, _, times, professor) in new.items()],
+                        interests
+                    )
+        except Exception as e:
+            self.record_error(e)
+            logger.error(f'An error occured while trying to add new courses to the DB: {e}')
+            return {}
+        if not saved:
+            return {}
+
+        for class_id, (class_name, status, times, professor) in new.items():
+            # Another add of the same course may have got here first.
+            if self.polling and class_id not in self.courses:
+                self.track_course(class_id, class_name, status, term, institution)
+                self.record_transition(class_id, status)
+            self.cache.put_course((class_id, status, term, class_name, times, professor))
+            logger.info(f'Succesfully added {class_id}. {class_name}: {status}. Professor: {professor}. Time: {times}.')
+        if user_id is not None:
+            self.cache.invalidate_user(user_id)
+        return added
+
+    async def add_new_course_to_db(self, class_id, term, institution='QNS01'):
+        return (await self.add_courses([class_id], term, institution)).get(class_id)
+
+    async def scrape_webpage_status(self, class_id, term, institution='QNS01'):
         try:
-            await access_db.add_course(conn, (class_id, status, term))
-            await access_db.add_course_details(conn, (class_id, class_name, time, professor))
-            logger.info(f'Succesfully added {class_id}. These were the details scraped:')
-            logger.info(f'{class_name}: {status}. Professor: {professor}. Time: {time}.')
+            content = await self.fetch_class_page(class_id, term, institution)
+            fingerprint = course_parser.fingerprint_class_page(content)
+            cached_result = self.fingerprints.get(class_id, fingerprint)
+            if cached_result:
+                return cached_result
+
+            webpage_class_id, class_name, status, _, _ = await self.parse_class_page(content)
+            result = (class_name, webpage_class_id, status)
+            if webpage_class_id == class_id:
+                self.fingerprints.put(class_id, fingerprint, result)
             return result
         except Exception as e:
-            logger.error(f'An error occured while trying to add a new course to the DB: {e}')
+            self.record_error(e)
+            logger.error(f'An error occurred while trying to scrape the webpage for the status: {e}')
             return None
-    
-    async def scrape_webpage_status(self, session, params):
-        async with self.semaphore:
-            try:
-                response = await session.get('https://globalsearch.cuny.edu/CFGlobalSearchTool/CFSearchToolController', params=params)
-                response.raise_for_status()
-                soup = BeautifulSoup(response.text, 'lxml')
-                
-                full_class_name = soup.find('div', {'class': 'shadowbox'}).find('p').get_text(strip=True)
-                class_id = soup.find('td', string=re.compile('\d+')).get_text(strip=True)
-                status = soup.find('img', alt=['Open', 'Close'])['alt']
-                if not full_class_name or not class_id or not status:
-                    raise ValueError('Failed to find the specified span in the HTML.')
-                class_name = re.search(r'\b[A-Z]+\s\d+', full_class_name).group()
-                return (class_name, class_id, status)
-            except Exception as e:
-                logger.error(f'An error occurred while trying to scrape the webpage for the status: {e}')
-                return None
             
-    async def sync_status_with_db(self, session, conn, params):
-        result = await self.scrape_webpage_status(session, params)
+    async def check_live_status(self, class_id, term, institution):
+        result = await self.scrape_webpage_status(class_id, term, institution)
+        if not result:
+            return None
+        class_name, webpage_class_id, status = result
+        checked_at = time.time()
+        course = self.courses.get(class_id)
+        if self.polling and webpage_class_id == class_id and course and course['term'] == term and course['institution'] == institution:
+            # A live check is as good as a poll, so a change it sees is announced and the next poll can wait.
+            changed = await self.apply_status(class_id, status)
+            self.report_status(class_name, class_id, status, changed)
+            if self.scheduler.deadlines.get(class_id) is not None:
+                # A course with a poll in flight is left for that poll to reschedule.
+                self.scheduler.record_result(class_id, changed)
+        return class_name, webpage_class_id, status, checked_at
+
+    async def check_status(self, class_id, term, institution='QNS01', max_age=None):
+        """Returns (class_name, class_id, status, age), where age is how many seconds old the status is.
+
+        The tracker's last observation is used when it is at most max_age seconds old (status_freshness by default).
+        Otherwise the page is fetched, and concurrent checks of the same class share that one request."""
+        max_age = self.status_freshness if max_age is None else max_age
+        course = self.courses.get(class_id)
+        observed_at = self.observed_at.get(class_id)
+        if course and observed_at and course['term'] == term and course['institution'] == institution:
+            age = time.time() - observed_at
+            if age <= max_age:
+                self.status_checks.inc(source='tracker')
+                return course['class_name'], class_id, course['status'], age
+
+        key = (institution, term, class_id)
+        if key in self.live_checks:
+            self.status_checks.inc(source='coalesced')
+        else:
+            self.status_checks.inc(source='live')
+            task = asyncio.create_task(self.check_live_status(class_id, term, institution))
+            self.live_checks[key] = task
+            task.add_done_callback(lambda _: self.live_checks.pop(key, None))
+        result = await asyncio.shield(self.live_checks[key])
+        if not result:
+            return None
+        class_name, webpage_class_id, status, checked_at = result
+        return class_name, webpage_class_id, status, time.time() - checked_at
+
+    async def close(self):
+        for task in self.poll_tasks:
+            task.cancel()
+        if self.tracking_started:
+            await self.save_snapshot()
+        if self.coordinator and self.db.is_open:
+            await self.coordinator.leave()
+        for partition in self.partitions.values():
+            if partition.done() and not partition.exception():
+                await partition.result().close()
+            else:
+                partition.cancel()
+        self.parse_executor.shutdown()
+        await self.flush_status_updates()
+        self.changes.close()
+        await self.db.close()
+        if self.metrics_server:
+            await self.metrics_server.close()
+            self.metrics_server = None
+
+    def owns(self, class_id):
+        return not self.coordinator or self.coordinator.owns(class_id)
+
+    async def load_courses(self):
+        with self.db_seconds.time(operation='load_courses'):
+            async with self.db.reader() as conn:
+                all_courses = await access_db.fetch_all_courses_with_names(conn)
+        self.courses = {
+            class_id: {'class_name': class_name, 'status': status, 'term': year_term, 'institution': institution}
+            for class_id, class_name, status, year_term, institution in all_courses if self.owns(class_id)
+        }
+        self.subject_groups.clear()
+        for class_id, course in self.courses.items():
+            self.scheduler.add(class_id, watchers=0)
+            self.add_to_subject_group(class_id, course)
+        await self.record_missing_history()
+        await self.refresh_watchers()
+        logger.info(f'Loaded {len(self.courses)} courses into memory.')
+
+    async def refresh_watchers(self):
+        self.last_watcher_refresh = time.monotonic()
+        with self.db_seconds.time(operation='watcher_counts'):
+            async with self.db.reader() as conn:
+                watcher_counts = await access_db.fetch_watcher_counts(conn)
+        self.scheduler.set_watchers(watcher_counts)
+
+    def subject_group_key(self, course):
+        if not course['class_name']:
+            return None
+        subject = course['class_name'].split()[0]
+        return (course['institution'], course['term'], subject)
+
+    def add_to_subject_group(self, class_id, course):
+        key = self.subject_group_key(course)
+        if key:
+            self.subject_groups[key].add(class_id)
+
+    def track_course(self, class_id, class_name, status, term, institution='QNS01'):
+        self.courses[class_id] = {'class_name': class_name, 'status': status, 'term': term, 'institution': institution}
+        self.add_to_subject_group(class_id, self.courses[class_id])
+        self.scheduler.add(class_id)
+
+    def untrack_course(self, class_id):
+        course = self.courses.pop(class_id, None)
+        if course:
+            key = self.subject_group_key(course)
+            if key in self.subject_groups:
+                self.subject_groups[key].discard(class_id)
+                if not self.subject_groups[key]:
+                    del self.subject_groups[key]
+        self.pending_status_updates.pop(class_id, None)
+        self.observed_at.pop(class_id, None)
+        self.bulk_unresolved.discard(class_id)
+        self.swept.discard(class_id)
+        self.scheduler.remove(class_id)
+        self.fingerprints.discard(class_id)
+        self.cache.invalidate_course(class_id)
+
+    async def load_course_row(self, class_id):
+        with self.db_seconds.time(operation='course_row'):
+            async with self.db.reader() as conn:
+                return await access_db.get_course_with_details_row(conn, class_id)
+
+    async def load_course_listing(self):
+        with self.db_seconds.time(operation='course_listing'):
+            async with self.db.reader() as conn:
+                return [row[:3] for row in await access_db.fetch_all_courses_with_names(conn)]
+
+    async def load_user_interests(self, user_id):
+        with self.db_seconds.time(operation='user_courses'):
+            async with self.db.reader() as conn:
+                rows = await access_db.fetch_user_courses_with_details(conn, user_id)
+        # The rows come back in full, so later per-course lookups are served from the cache.
+        for row in rows:
+            self.cache.put_course(row)
+        return [row[0] for row in rows]
+
+    async def get_course_info(self, class_id):
+        return await self.cache.get_course(class_id, self.load_course_row)
+
+    async def get_all_tracked_courses(self):
+        return await self.cache.get_listing(self.load_course_listing)
+
+    async def get_user_tracked_courses(self, user_id):
+        class_ids = await self.cache.get_user_interests(str(user_id), self.load_user_interests)
+        courses = []
+        for class_id in class_ids:
+            row = await self.get_course_info(class_id)
+            if row:
+                courses.append((class_id, row[3], row[1]))
+        return courses
+
+    def record_transition(self, class_id, status):
+        if class_id.isdigit():
+            self.pending_transitions.append((int(class_id), int(time.time()), status_history.encode_status(status)))
+
+    async def record_missing_history(self):
+        # Courses tracked before the history existed start theirs with the status they were loaded with.
+        async with self.db.reader() as conn:
+            with_history = await access_db.fetch_classes_with_history(conn)
+        for class_id, course in self.courses.items():
+            if class_id.isdigit() and int(class_id) not in with_history and course['status']:
+                self.record_transition(class_id, course['status'])
+
+    async def flush_status_updates(self):
+        if not self.pending_status_updates and not self.pending_transitions:
+            return
+        pending, self.pending_status_updates = self.pending_status_updates, {}
+        transitions, self.pending_transitions = self.pending_transitions, []
+        self.last_flush = time.monotonic()
+        with self.db_seconds.time(operation='flush_statuses'):
+            async with self.db.writer() as conn:
+                if self.coordinator:
+                    changes = [(class_id, self.courses.get(class_id, {}).get('class_name'), status) for class_id, status in pending.items()]
+                    flushed = await access_db.publish_status_changes(conn, changes, self.worker_id, time.time()) is not None
+                else:
+                    flushed = await access_db.update_course_statuses(conn, [(status, class_id) for class_id, status in pending.items()])
+                recorded = await access_db.add_status_transitions(conn, transitions)
+        if not flushed:
+            logger.warning(f'Could not flush {len(pending)} status updates. They will be retried on the next flush.')
+            for class_id, status in pending.items():
+                if class_id in self.courses:
+                    self.pending_status_updates.setdefault(class_id, status)
+        if not recorded:
+            logger.warning(f'Could not record {len(transitions)} status transitions. They will be retried on the next flush.')
+            self.pending_transitions = transitions + self.pending_transitions
+
+    async def roll_up_history(self):
+        self.last_history_rollup = time.monotonic()
+        now = int(time.time())
+        with self.db_seconds.time(operation='history_rollup'):
+            async with self.db.reader() as conn:
+                # The last rolled up day is redone because it was probably still in progress.
+                first_day = await access_db.get_last_rollup_day(conn)
+                if first_day is None:
+                    first_transition = await access_db.get_first_transition_time(conn)
+                    if first_transition is None:
+                        return
+                    first_day = status_history.day_of(first_transition)
+                transitions = await access_db.fetch_transitions_for_rollup(conn, status_history.day_start(first_day))
+            daily, hourly = status_history.roll_up(transitions, first_day, now)
+            async with self.db.writer() as conn:
+                await access_db.save_status_rollups(conn, daily, hourly)
+                pruned = await access_db.prune_status_transitions(conn, now - self.history_retention_days * 86400)
+        logger.info(f'Rolled up {len(daily)} course days and {len(hourly)} course hours. Pruned {pruned} old transitions.')
+
+    async def get_course_history(self, class_id, days=7):
+        """Returns the daily (day, open_seconds, flips) rollups, hourly (hour, flips) counts and the last transition for a course."""
+        first_day = status_history.day_of(time.time()) - days + 1
+        with self.db_seconds.time(operation='course_history'):
+            async with self.db.reader() as conn:
+                daily = await access_db.fetch_course_daily_rollups(conn, int(class_id), first_day)
+                hourly = await access_db.fetch_course_hourly_flips(conn, int(class_id), status_history.day_start(first_day) // 3600)
+                last_transition = await access_db.get_last_transition(conn, int(class_id))
+        return daily, hourly, last_transition
+
+    async def apply_status(self, class_id, status):
+        course = self.courses.get(class_id)
+        if not course:
+            return False
+        self.observed_at[class_id] = time.time()
+        if status == course['status']:
+            return False
+
+        course['status'] = status
+        self.pending_status_updates[class_id] = status
+        self.record_transition(class_id, status)
+        self.cache.update_status(class_id, status)
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            await self.flush_status_updates()
+        return True
+
+    async def sync_status_with_db(self, class_id):
+        course = self.courses[class_id]
+        result = await self.scrape_webpage_status(class_id, course['term'], course['institution'])
         if not result:
             logger.error('An error occured while scraping the webpage. Cannot sync status with DB.')
             return None
         
         class_name, class_id, status = result
+        if class_id not in self.courses:
+            logger.warning(f'Scraped {class_name}-{class_id}, but it is no longer being tracked.')
+            return None
+        changed = await self.apply_status(class_id, status)
+        return (class_name, class_id, status, changed)
+
+    async def sync_subject_group(self, key):
+        """Updates every tracked section of a subject from one results listing.
+
+        Returns the statuses found so the caller can tell which sections were resolved."""
+        institution, term, subject = key
         try:
-            _, stored_status = await access_db.get_course_name_and_status(conn, class_id)
-            if status != stored_status:
-                await access_db.update_course_status(conn, class_id, status)
-                return (class_name, class_id, status, True)
-            return (class_name, class_id, status, False)
+            content = await self.fetch_results_listing(institution, term, subject, self.bulk_career)
+            with self.parse_seconds.time(page='listing'):
+                statuses = await self.parse_executor.run(course_parser.extract_results_listing, content)
         except Exception as e:
-            logger.error(f'An error occurred while trying to sync the status with the DB: {e}')
+            self.record_error(e)
+            logger.error(f'An error occurred while fetching the {subject} results listing for {institution} {term}: {e}')
+            return {}
+
+        results = {}
+        for class_id in list(self.subject_groups.get(key, ())):
+            if class_id in statuses:
+                results[class_id] = await self.apply_status(class_id, statuses[class_id])
+                self.swept.add(class_id)
+            else:
+                # Not on a listing that did come back (e.g. a different career or a Wait List status), so use
+                # class pages for it from now on. A failed fetch returns above without demoting anything.
+                self.bulk_unresolved.add(class_id)
+        return results
+
+    def report_status(self, class_name, class_id, status, changed):
+        if changed:
+            logger.info(f'Course Status Changed: {class_name}-{class_id}: {status}')
+            self.changes.publish(change_stream.ChangeEvent(class_id, class_name, status, time.time()))
+        poll_logger.debug('%s-%s: %s', class_name, class_id, status)
+
+    def bulk_group_for(self, class_id):
+        if not self.bulk_mode or class_id in self.bulk_unresolved:
             return None
-    
-    async def start_tracking(self, term):
+        key = self.subject_group_key(self.courses[class_id])
+        if key and len(self.subject_groups.get(key, ())) >= self.bulk_threshold:
+            return key
+        return None
+
+    async def poll_subject_group(self, key, class_id):
+        results = await self.sync_subject_group(key)
+        for member_id, member_changed in results.items():
+            course = self.courses.get(member_id)
+            if not course:
+                continue
+            self.report_status(course['class_name'], member_id, course['status'], member_changed)
+            if member_id != class_id and self.scheduler.deadlines.get(member_id) is not None:
+                # Every section on the listing was just checked, so push their next polls back as well.
+                # A section with its own poll in flight is left for that poll to reschedule.
+                self.scheduler.record_result(member_id, member_changed)
+        return results
+
+    def record_sweep_progress(self, class_id):
+        # A sweep ends once every tracked course has been polled at least once since the previous one ended.
+        self.polls_this_sweep += 1
+        if class_id in self.courses:
+            self.swept.add(class_id)
+        if self.courses and len(self.swept) >= len(self.courses):
+            now = time.monotonic()
+            self.sweep_seconds.observe(now - self.sweep_started)
+            self.sweep_courses.set(len(self.swept))
+            self.sweep_polls.set(self.polls_this_sweep)
+            self.sweep_started = now
+            self.swept = set()
+            self.polls_this_sweep = 0
+
+    async def poll_course(self, class_id):
+        changed = False
+        outcome = 'error'
+        try:
+            if class_id not in self.courses:
+                outcome = 'untracked'
+                return
+            group = self.bulk_group_for(class_id)
+            if group:
+                results = await self.poll_subject_group(group, class_id)
+                if class_id in results:
+                    changed = results[class_id]
+                    outcome = 'changed' if changed else 'unchanged'
+                    return
+
+            result = await self.sync_status_with_db(class_id)
+            if not result:
+                logger.warning(f'Polling {class_id} returned no results.')
+                return
+
+            class_name, webpage_class_id, status, changed = result
+            outcome = 'changed' if changed else 'unchanged'
+            self.report_status(class_name, webpage_class_id, status, changed)
+        except Exception as e:
+            self.record_error(e)
+            logger.error(f'An error occurred while polling {class_id}: {e}')
+        finally:
+            self.polls.inc(result=outcome)
+            self.record_sweep_progress(class_id)
+            self.scheduler.record_result(class_id, changed)
+            self.max_in_flight.release()
+
+    async def run_housekeeping(self):
+        now = time.monotonic()
+        if now - self.last_flush >= self.flush_interval:
+            await self.flush_status_updates()
+        if now - self.last_watcher_refresh >= self.watcher_refresh_interval:
+            await self.refresh_watchers()
+        if now - self.last_history_rollup >= self.history_rollup_interval:
+            await self.roll_up_history()
+        if self.snapshot_path and now - self.last_snapshot >= self.snapshot_interval:
+            await self.save_snapshot()
+        if self.coordinator and self.coordinator.heartbeat_due():
+            await self.coordinator.heartbeat()
+            await self.sync_courses()
+        # Poll intervals are shares of whatever rate the governor currently allows.
+        self.scheduler.requests_per_second = self.governor.current_rate
+
+    async def start_partitions(self, restored_sessions=None):
+        restored_sessions = restored_sessions or {}
+        groups = {(course['institution'], course['term']) for course in self.courses.values()}
+        results = await asyncio.gather(*(self.get_partition(*group, restored_sessions.get(group, ())) for group in groups),
+                                       return_exceptions=True)
+        for (institution, term), result in zip(groups, results):
+            if isinstance(result, Exception):
+                logger.error(f'Could not start a session partition for {institution} {term}: {result}')
+
+    def snapshot_state(self):
+        sessions = [
+            [institution, term, partition.result().snapshot()] for (institution, term), partition in self.partitions.items()
+            if partition.done() and not partition.cancelled() and not partition.exception()
+        ]
+        return {
+            'terms': dict(self.all_terms or {}),
+            'scheduler': self.scheduler.snapshot(),
+            'fingerprints': self.fingerprints.snapshot(),
+            'sessions': sessions
+        }
+
+    async def save_snapshot(self):
+        self.last_snapshot = time.monotonic()
+        if not self.snapshot_path:
+            return
+        try:
+            # The state is gathered on the loop so it is consistent; only encoding and writing it happen off the loop.
+            size = await asyncio.to_thread(tracker_snapshot.save, self.snapshot_path, self.snapshot_state())
+            logger.debug(f'Saved a {size} byte snapshot to {self.snapshot_path}.')
+        except Exception as e:
+            self.record_error(e)
+            logger.error(f'Could not save a snapshot to {self.snapshot_path}: {e}')
+
+    async def restore_snapshot(self):
+        """Picks up terms, poll deadlines, page fingerprints and sessions from the last snapshot, if it is fresh enough.
+
+        Returns the restored sessions by (institution, term). Courses and their statuses always come from the database,
+        which is flushed far more often than snapshots are taken."""
+        if not self.snapshot_path:
+            return {}
+        loaded = await asyncio.to_thread(tracker_snapshot.load, self.snapshot_path, self.snapshot_max_age)
+        if not loaded:
+            return {}
+        state, age = loaded
+        try:
+            terms = dict(state['terms'])
+            sessions = {
+                (institution, term): [dict(session, age=session['age'] + age) for session in restored]
+                for institution, term, restored in state['sessions']
+            }
+            self.scheduler.restore(state['scheduler'], age)
+            self.fingerprints.restore(entry for entry in state['fingerprints'] if entry[0] in self.courses)
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning(f'Could not restore the snapshot at {self.snapshot_path}: {e}')
+            return {}
+        if terms:
+            self.all_terms = terms
+        logger.info(f'Restored the snapshot from {age:.0f} seconds ago with {sum(map(len, sessions.values()))} sessions.')
+        return sessions
+
+    async def start_metrics_server(self):
+        if self.metrics_port and not self.metrics_server:
+            self.metrics_server = metrics.MetricsServer(self.metrics, port=self.metrics_port)
+            await self.metrics_server.start()
+
+    def get_stats(self):
+        request_seconds = self.metrics.get('globalsearch_request_seconds')
+        recreations = self.metrics.get('globalsearch_session_recreations_total')
+        errors = dict(self.errors.values)
+        request_errors = self.metrics.get('globalsearch_request_errors_total')
+        for key, count in (request_errors.values.items() if request_errors else ()):
+            errors[key] = errors.get(key, 0) + count
+        return {
+            'courses': len(self.courses),
+            'polls': {key[0]: count for key, count in self.polls.values.items()},
+            'request_rate': self.governor.current_rate,
+            'request_p50': request_seconds.quantile(0.5, method='GET') if request_seconds else None,
+            'request_p95': request_seconds.quantile(0.95, method='GET') if request_seconds else None,
+            'parse_p95': self.parse_seconds.quantile(0.95, page='class'),
+            'flush_p95': self.db_seconds.quantile(0.95, operation='flush_statuses'),
+            'sweeps': self.sweep_seconds.count(),
+            'last_sweep_courses': self.sweep_courses.get(),
+            'last_sweep_polls': self.sweep_polls.get(),
+            'sweep_p50': self.sweep_seconds.quantile(0.5),
+            'session_recreations': recreations.get() if recreations else 0,
+            'errors': {key[0]: count for key, count in errors.items()},
+            'fingerprint_hit_rate': self.fingerprints.hit_rate,
+            'cache_hit_rate': self.cache.hit_rate
+        }
+
+    async def sync_courses(self):
+        # Other processes add and remove courses, and ownership moves whenever workers join or leave.
+        await self.flush_status_updates()
+        async with self.db.reader() as conn:
+            all_courses = await access_db.fetch_all_courses_with_names(conn)
+        owned = {row[0]: row for row in all_courses if self.owns(row[0])}
+        released = [class_id for class_id in self.courses if class_id not in owned]
+        for class_id in released:
+            self.untrack_course(class_id)
+        acquired = [row for class_id, row in owned.items() if class_id not in self.courses]
+        for class_id, class_name, status, year_term, institution in acquired:
+            self.track_course(class_id, class_name, status, year_term, institution)
+        if released or acquired:
+            logger.info(f'Released {len(released)} and took over {len(acquired)} courses. Now polling {len(self.courses)}.')
+            await self.refresh_watchers()
+
+    async def consume_change_events(self, on_change=None, consumer='discord_bot', poll_interval=1.0, batch_size=100,
+                                    retention=86400):
+        """Publishes the status changes from tracker workers to the change stream and passes them to on_change, in order.
+
+        The position of the last delivered event is saved after each one, so a restart resumes where it
+        left off. Only on_change gets that guarantee; stream subscribers may lose events to their lag policy.
+        Changes only reach change_events through the workers, so from here on nothing else in this
+        process tracks courses or writes statuses: a live check just answers, and new courses are left to the workers."""
+        self.polling = False
         await self.initialize_db()
-        self.session = await self.create_session(term)
+        async with self.db.reader() as conn:
+            last_event_id = await access_db.get_event_cursor(conn, consumer)
+            if last_event_id is None:
+                last_event_id = await access_db.get_last_event_id(conn) or 0
+        last_prune = time.monotonic()
+
+        while True:
+            async with self.db.reader() as conn:
+                events = await access_db.fetch_change_events(conn, last_event_id, batch_size)
+            for event_id, class_id, class_name, status in events:
+                self.cache.update_status(class_id, status)
+                self.changes.publish(change_stream.ChangeEvent(class_id, class_name, status, time.time()))
+                try:
+                    if on_change:
+                        await on_change(class_name, class_id, status)
+                except Exception as e:
+                    self.record_error(e)
+                    logger.error(f'An error occurred while delivering the change event for {class_id}: {e}')
+                last_event_id = event_id
+                async with self.db.writer() as conn:
+                    await access_db.set_event_cursor(conn, consumer, last_event_id)
+
+            if time.monotonic() - last_prune >= self.history_rollup_interval:
+                last_prune = time.monotonic()
+                async with self.db.writer() as conn:
+                    await access_db.prune_change_events(conn, last_event_id, time.time() - retention)
+            if len(events) < batch_size:
+                await asyncio.sleep(poll_interval)
+
+    async def start_tracking(self):
+        await self.initialize_db()
+        if self.coordinator:
+            await self.coordinator.heartbeat()
+        await self.load_courses()
+        restored_sessions = await self.restore_snapshot()
+        if self.all_terms is None:
+            await self.load_terms()
+        await self.start_metrics_server()
+        await self.start_partitions(restored_sessions)
+        self.sweep_started = time.monotonic()
+        self.tracking_started = True
             
         while True:
-            if not self.session_active:
-                logger.info('Session is not active. Sleeping for 10 seconds.')
+            if not self.courses:
+                logger.info('No courses are in the database. Sleeping for 10 seconds.')
+                # Workers still need to heartbeat and pick up courses while they have none.
+                await self.run_housekeeping()
                 await asyncio.sleep(10)
                 continue
-            try:
-                async with aiosqlite.connect('classes.db') as conn:
-                    all_courses = await access_db.fetch_all_courses(conn)
-                    if not all_courses:
-                        logger.info('No courses are in the database. Sleeping for 10 seconds.')
-                        await asyncio.sleep(10)
-                        continue
-            except Exception as e:
-                logger.error(f'An error occured while trying to fetch all courses from the DB: {e}')
-                exit(1)
-                
-            params = [await self.encode_and_generate_params(class_number, year_term) for class_number, _, year_term in all_courses]
-            try:
-                async with aiosqlite.connect('classes.db') as conn:
-                    tasks = [self.sync_status_with_db(self.session, conn, param) for param in params]
-                    for completed_task in asyncio.as_completed(tasks):
-                        result = await completed_task
-                        if result:
-                            class_name, class_id, status, changed = result
-                            if changed:
-                                logger.info(f'Course Status Changed: {class_name}-{class_id}: {status}')
-                            print(f'{class_name}-{class_id}: {status}')
-                        else:
-                            print('Error: No results.')
-                        await asyncio.sleep(round(random.uniform(0.05, 0.2), 2))
-                    await asyncio.sleep(round(random.uniform(2.66, 4.66), 2))
-            except Exception as e:
-                logger.error(f'An error occurred: {e}\nTrying to recreate session in {self.wait_time} seconds.')
-                self.session_active = False
-                await self.session.aclose()
-                self.session = await self.create_session(term)
+
+            class_id = await self.scheduler.next_due(timeout=self.flush_interval)
+            if class_id is None:
+                await self.run_housekeeping()
+                continue
+
+            await self.max_in_flight.acquire()
+            task = asyncio.create_task(self.poll_course(class_id))
+            self.poll_tasks.add(task)
+            task.add_done_callback(self.poll_tasks.discard)
+
+            await self.run_housekeeping()
+
+
+async def print_changes(subscription):
+    async for event in subscription:
+        changed_at = time.strftime('%H:%M:%S', time.localtime(event.changed_at))
+        print(f'[{changed_at}] {event.class_name}-{event.class_id} is now {event.status}')
 
 
 async def main():
-    tracker = CourseTracker()
-    await tracker.start_tracking('2023 Fall Term')
+    parser = argparse.ArgumentParser(description='Tracks course statuses on CUNY Global Search.')
+    parser.add_argument('--worker', action='store_true',
+                        help='Poll only this worker\'s share of the courses and publish changes for the bot.')
+    parser.add_argument('--worker-id', default=f'{socket.gethostname()}-{os.getpid()}')
+    parser.add_argument('--metrics-port', type=int, default=None)
+    parser.add_argument('--bulk', action='store_true', help='Poll subjects with enough tracked sections through one results listing each.')
+    parser.add_argument('--auto-enroll', metavar='FILE', help='JSON list of classes to add or swap into through Schedule Builder as soon as they open.')
+    args = parser.parse_args()
+
+    tracker = CourseTracker(metrics_port=args.metrics_port, worker_id=args.worker_id if args.worker else None, bulk_mode=args.bulk)
+    tasks = [asyncio.create_task(print_changes(tracker.changes.subscribe('cli', policy=change_stream.DROP_NEWEST)))]
+    if args.auto_enroll:
+        # Imported here so the tracker alone does not need the Schedule Builder certificate.
+        import auto_enroll
+        import schedule_builder
+        builder = schedule_builder.ScheduleBuilderClient(tracker.db, registry=tracker.metrics)
+        pipeline = auto_enroll.EnrollPipeline(tracker, builder, auto_enroll.load_targets(args.auto_enroll))
+        tasks.append(asyncio.create_task(pipeline.run()))
+    try:
+        await tracker.start_tracking()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await tracker.close()
 
 
 if __name__ == '__main__':
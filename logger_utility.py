@@ -1,28 +1,120 @@
 import os
+import json
+import queue
+import atexit
 import logging
+import itertools
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
 
-root_logger_set = False
+# Everything below can be set from the environment:
+#   LOG_LEVEL           level for the log files, INFO unless set (DEBUG turns on the sampled per-course lines)
+#   LOG_CONSOLE_LEVEL   level for the console, WARNING unless set
+#   LOG_FORMAT          "text" or "json" for one compact JSON object per line
+#   LOG_MAX_BYTES       size a log file rotates at, 10 MB unless set
+#   LOG_BACKUP_COUNT    rotated files kept per log, 5 unless set
+#   LOG_ROTATE_WHEN     rotate on time instead of size, e.g. "midnight" or "H"
+LOG_DIR = 'logs'
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
 
+log_queue = queue.SimpleQueue()
+listener = None
+router = None
 
-def setup_logger(logger_name, filename):
-    global root_logger_set
 
-    if not os.path.exists('logs'):
-        os.makedirs('logs')
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'ts': round(record.created, 3), 'level': record.levelname, 'logger': record.name, 'msg': record.getMessage()}
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(',', ':'))
+
+
+class FileRouter(logging.Handler):
+    """Sends each record to the file of the logger that made it. Only the listener thread calls it."""
+
+    def __init__(self):
+        super().__init__()
+        self.handlers = {}
+
+    def emit(self, record):
+        handler = self.handlers.get(record.name)
+        if handler:
+            handler.handle(record)
+
+    def close(self):
+        for handler in self.handlers.values():
+            handler.close()
+        super().close()
+
+
+class SampledLogger:
+    """Logs one in every `every` debug calls, for lines that would otherwise be written on every poll.
+
+    Arguments are %-style so nothing is formatted unless the line is actually written."""
+
+    def __init__(self, logger, every=100):
+        self.logger = logger
+        self.every = every
+        self.calls = itertools.count()
+
+    def debug(self, message, *args):
+        if self.logger.isEnabledFor(logging.DEBUG) and next(self.calls) % self.every == 0:
+            self.logger.debug(message, *args)
+
+
+def make_formatter():
+    return JsonFormatter() if os.getenv('LOG_FORMAT', 'text').lower() == 'json' else logging.Formatter(TEXT_FORMAT)
+
+
+def make_file_handler(filename):
+    path = os.path.join(LOG_DIR, filename)
+    if os.getenv('LOG_ROTATE_WHEN'):
+        handler = TimedRotatingFileHandler(path, when=os.getenv('LOG_ROTATE_WHEN'), backupCount=int(os.getenv('LOG_BACKUP_COUNT', 5)),
+                                           delay=True)
+    else:
+        handler = RotatingFileHandler(path, maxBytes=int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024)),
+                                      backupCount=int(os.getenv('LOG_BACKUP_COUNT', 5)), delay=True)
+    handler.setFormatter(make_formatter())
+    return handler
+
+
+def start_listener():
+    global listener, router
+    router = FileRouter()
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(os.getenv('LOG_CONSOLE_LEVEL', 'WARNING').upper())
+    console_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    # Files and the console are written on the listener's thread, never on the event loop.
+    listener = QueueListener(log_queue, router, console_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop_listener)
+
+    # Libraries that log through the root logger (discord.py, httpx) reach the console the same way.
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.WARNING)
+    root_logger.addHandler(QueueHandler(log_queue))
+
+
+def stop_listener():
+    global listener
+    if listener:
+        # Writes out whatever is still queued before the files are closed.
+        listener.stop()
+        router.close()
+        listener = None
+
+
+def setup_logger(logger_name, filename):
+    if listener is None:
+        os.makedirs(LOG_DIR, exist_ok=True)
+        start_listener()
 
     logger = logging.getLogger(logger_name)
-    logger.setLevel(logging.INFO)
-
-    file_handler = logging.FileHandler(os.path.join('logs', filename))
-    file_handler.setLevel(logging.INFO)
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
-
-    if not root_logger_set:
-        stream_handler = logging.StreamHandler()
-        stream_handler.setLevel(logging.INFO)
-        stream_handler.setFormatter(formatter)
-        logging.getLogger().addHandler(stream_handler)
-        root_logger_set = True
+    if logger_name in router.handlers:
+        return logger
+    logger.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+    router.handlers[logger_name] = make_file_handler(filename)
+    logger.addHandler(QueueHandler(log_queue))
+    # The records already go to the console through the listener, so they must not reach the root logger's handler too.
+    logger.propagate = False
     return logger
@@ -0,0 +1,212 @@
+import math
+import time
+import asyncio
+import bisect
+from contextlib import contextmanager
+import logger_utility
+
+logger = logger_utility.setup_logger(__name__, 'metrics.log')
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+PARSE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+DB_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+SWEEP_BUCKETS = (10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=()):
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_value(value):
+    # :g would round to 6 significant digits, so a large counter would seem to stall and then jump.
+    if isinstance(value, int):
+        return str(int(value))
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if math.isnan(value):
+        return 'NaN'
+    return repr(float(value))
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.values = {}
+
+    def key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f'{self.name} expects labels {self.label_names}, but got {tuple(labels)}.')
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name, format_labels(self.label_names, key), value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(f'{name}{labels} {format_value(value)}' for name, labels, value in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), func=None):
+        super().__init__(name, documentation, labels)
+        # Gauges backed by a function are read when the metrics are rendered instead of being set.
+        self.func = func
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+    def get(self, **labels):
+        if self.func:
+            return self.func()
+        return self.values.get(self.key(labels), 0)
+
+    def samples(self):
+        if self.func:
+            yield self.name, '', self.func()
+        else:
+            yield from super().samples()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        entry = self.values.get(key)
+        if entry is None:
+            # One count per bucket plus +Inf, then the sum of every observation.
+            entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        entry = self.values.get(self.key(labels))
+        return sum(entry[0]) if entry else 0
+
+    def quantile(self, fraction, **labels):
+        """Estimates a quantile as the upper bound of the bucket it falls in."""
+        entry = self.values.get(self.key(labels))
+        if not entry:
+            return None
+        target = fraction * sum(entry[0])
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), entry[0]):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return float('inf')
+
+    def samples(self):
+        for key, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = format_value(bound)
+                yield f'{self.name}_bucket', format_labels(self.label_names, key, [('le', le)]), cumulative
+            yield f'{self.name}_sum', format_labels(self.label_names, key), total
+            yield f'{self.name}_count', format_labels(self.label_names, key), cumulative
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric_class, name, documentation, labels=(), **kwargs):
+        # Several pools or modules can ask for the same metric; they all share the first one registered.
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = metric_class(name, documentation, labels, **kwargs)
+        elif not isinstance(metric, metric_class):
+            raise ValueError(f'{name} is already registered as a {metric.kind}.')
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter, name, documentation, labels)
+
+    def gauge(self, name, documentation, labels=(), func=None):
+        return self.register(Gauge, name, documentation, labels, func=func)
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram, name, documentation, labels, buckets=buckets)
+
+    def get(self, name):
+        return self.metrics.get(name)
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self.metrics.values()) + '\n'
+
+
+class MetricsServer:
+    """Serves the registry in the Prometheus text format at /metrics."""
+
+    def __init__(self, registry, host='127.0.0.1', port=9108):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.registry.render().encode()
+            else:
+                status, body = '404 Not Found', b'Not Found\n'
+            writer.write(
+                f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.warning(f'An error occurred while serving a metrics request: {e}')
+        finally:
+            writer.close()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        logger.info(f'Serving metrics at http://{self.host}:{self.port}/metrics')
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
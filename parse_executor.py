@@ -0,0 +1,42 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import logger_utility
+
+logger = logger_utility.setup_logger(__name__, 'parse_executor.log')
+
+
+class ParseExecutor:
+    def __init__(self, kind='thread', max_workers=2, max_pending=8):
+        if kind not in ('thread', 'process', 'inline'):
+            raise ValueError(f'Invalid parse executor kind. Expected "thread", "process" or "inline", but got {kind}.')
+        self.kind = kind
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.executor = None
+        # Callers wait here once max_pending pages are queued or being parsed, so the executor's queue
+        # stays short. The slot is taken after the fetch, so this does not limit fetching; polls are
+        # bounded by the tracker's max_in_flight, which also caps how many fetched pages wait here.
+        self.pending = asyncio.BoundedSemaphore(max_pending)
+
+    def start(self):
+        if self.executor or self.kind == 'inline':
+            return
+        if self.kind == 'process':
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='parse')
+        logger.info(f'Started a {self.kind} parse executor with {self.max_workers} workers and {self.max_pending} pending slots.')
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def run(self, func, *args, **kwargs):
+        async with self.pending:
+            if self.kind == 'inline':
+                return func(*args, **kwargs)
+            self.start()
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
@@ -0,0 +1,153 @@
+import time
+import heapq
+import random
+import asyncio
+from collections import deque
+
+
+class PollScheduler:
+    def __init__(self, requests_per_second=2.0, min_interval=3.0, max_interval=300.0,
+                 watcher_weight=1.0, change_weight=4.0, change_window=3600, jitter=0.1):
+        self.requests_per_second = requests_per_second
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.watcher_weight = watcher_weight
+        self.change_weight = change_weight
+        self.change_window = change_window
+        self.jitter = jitter
+
+        self.deadlines = {}
+        self.heap = []
+        self.watchers = {}
+        self.changes = {}
+        self.weights = {}
+        self.total_weight = 0.0
+        self.wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, class_id):
+        return class_id in self.deadlines
+
+    def compute_weight(self, class_id, now):
+        recent_changes = self.changes.get(class_id)
+        while recent_changes and now - recent_changes[0] > self.change_window:
+            recent_changes.popleft()
+        changes_per_hour = len(recent_changes) * 3600 / self.change_window if recent_changes else 0
+        return 1 + self.watcher_weight * self.watchers.get(class_id, 0) + self.change_weight * changes_per_hour
+
+    def update_weight(self, class_id, now):
+        weight = self.compute_weight(class_id, now)
+        self.total_weight += weight - self.weights.get(class_id, 0)
+        self.weights[class_id] = weight
+
+    def refresh_weights(self):
+        # Change counts decay as they leave the window, so weights are recomputed in full now and then.
+        now = time.monotonic()
+        self.weights = {class_id: self.compute_weight(class_id, now) for class_id in self.deadlines}
+        self.total_weight = sum(self.weights.values())
+
+    def interval(self, class_id):
+        # Each course gets a share of the global budget proportional to its weight, so the
+        # sum of 1 / interval over every course stays close to requests_per_second.
+        weight = self.weights.get(class_id, 1)
+        interval = self.total_weight / (self.requests_per_second * weight)
+        interval *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def schedule(self, class_id, deadline):
+        self.deadlines[class_id] = deadline
+        heapq.heappush(self.heap, (deadline, class_id))
+        if self.heap[0][1] == class_id:
+            self.wakeup.set()
+
+    def add(self, class_id, watchers=1):
+        now = time.monotonic()
+        self.watchers[class_id] = watchers
+        self.update_weight(class_id, now)
+        if class_id not in self.deadlines:
+            self.schedule(class_id, now)
+
+    def remove(self, class_id):
+        self.deadlines.pop(class_id, None)
+        self.watchers.pop(class_id, None)
+        self.changes.pop(class_id, None)
+        self.total_weight -= self.weights.pop(class_id, 0)
+
+    def set_watchers(self, watcher_counts):
+        for class_id in self.deadlines:
+            self.watchers[class_id] = watcher_counts.get(class_id, 0)
+        self.refresh_weights()
+
+    def record_result(self, class_id, changed):
+        if class_id not in self.deadlines:
+            return
+        now = time.monotonic()
+        if changed:
+            self.changes.setdefault(class_id, deque()).append(now)
+            self.update_weight(class_id, now)
+            # A course that just flipped is likely to flip again soon, so check it again as early as allowed.
+            self.schedule(class_id, now + self.min_interval)
+        else:
+            self.schedule(class_id, now + self.interval(class_id))
+
+    def snapshot(self):
+        # Monotonic times mean nothing to another process, so everything is saved as seconds from now.
+        now = time.monotonic()
+        return {
+            class_id: [max(deadline - now, 0) if deadline is not None else 0, [now - changed for changed in self.changes.get(class_id, ())]]
+            for class_id, deadline in self.deadlines.items()
+        }
+
+    def restore(self, state, elapsed):
+        """Carries deadlines and recent changes over from a snapshot taken elapsed seconds ago, for courses already added."""
+        now = time.monotonic()
+        for class_id, (remaining, change_ages) in state.items():
+            if class_id not in self.deadlines:
+                continue
+            changes = deque(now - age - elapsed for age in change_ages if age + elapsed <= self.change_window)
+            if changes:
+                self.changes[class_id] = changes
+            self.schedule(class_id, now + max(remaining - elapsed, 0))
+        self.refresh_weights()
+
+    def pop_due(self):
+        now = time.monotonic()
+        while self.heap:
+            deadline, class_id = self.heap[0]
+            if self.deadlines.get(class_id) != deadline:
+                heapq.heappop(self.heap) # Stale entry from a reschedule or removal.
+                continue
+            if deadline > now:
+                return None
+            heapq.heappop(self.heap)
+            # Mark as in flight so it is not handed out again until record_result reschedules it.
+            self.deadlines[class_id] = None
+            return class_id
+        return None
+
+    def time_until_next(self):
+        while self.heap and self.deadlines.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return None
+        return max(self.heap[0][0] - time.monotonic(), 0)
+
+    async def next_due(self, timeout=None):
+        give_up_at = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            class_id = self.pop_due()
+            if class_id is not None:
+                return class_id
+            wait = self.time_until_next()
+            if give_up_at is not None:
+                remaining = give_up_at - time.monotonic()
+                if remaining <= 0:
+                    return None
+                wait = remaining if wait is None else min(wait, remaining)
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,77 @@
+import time
+import asyncio
+import logger_utility
+
+logger = logger_utility.setup_logger(__name__, 'rate_governor.log')
+
+
+class RateGovernor:
+    def __init__(self, rate=2.0, burst=4, min_rate=0.25, max_rate=10.0,
+                 increase_step=0.1, decrease_factor=0.5, healthy_streak=20, decrease_cooldown=2.0):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.healthy_streak = healthy_streak
+        self.decrease_cooldown = decrease_cooldown
+
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+        self.paused_until = 0
+        self.successes = 0
+        self.last_decrease = 0
+        self.lock = asyncio.Lock()
+
+    @property
+    def current_rate(self):
+        return self.rate
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    async def acquire(self):
+        # The lock makes waiters take tokens in arrival order instead of racing for each refill.
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def record_success(self):
+        self.successes += 1
+        if self.successes >= self.healthy_streak and self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.increase_step)
+            self.successes = 0
+
+    def record_failure(self, reason, retry_after=None):
+        self.successes = 0
+        now = time.monotonic()
+        if retry_after:
+            self.paused_until = max(self.paused_until, now + retry_after)
+        # Requests already in flight tend to fail together, so one burst of errors only backs off once.
+        if now - self.last_decrease < self.decrease_cooldown:
+            return
+        self.last_decrease = now
+        new_rate = max(self.min_rate, self.rate * self.decrease_factor)
+        if new_rate != self.rate:
+            logger.warning(f'Backing off from {self.rate:.2f} to {new_rate:.2f} requests per second after {reason}.')
+        self.rate = new_rate
+        self.tokens = min(self.tokens, 1)
+
+    def record_response(self, response):
+        if response.status_code == 429 or response.status_code >= 500:
+            retry_after = response.headers.get('Retry-After')
+            self.record_failure(
+                f'HTTP {response.status_code}', float(retry_after) if retry_after and retry_after.isdigit() else None
+            )
+        else:
+            self.record_success()
@@ -1,86 +1,232 @@
 import time
 import os
 import ssl
-import aiosqlite
+import asyncio
 import httpx
 from bs4 import BeautifulSoup
 import access_db
+import db_manager
+import metrics
 import logger_utility
 
 logger = logger_utility.setup_logger(__name__, 'schedule_builder.log')
 context = ssl.create_default_context()
-context.load_verify_locations(cafile='DigiCertTLSRSASHA2562020CA1-1.crt.pem')
+context.load_verify_locations(cafile=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'DigiCertTLSRSASHA2562020CA1-1.crt.pem'))
 
-headers = {'User-Agent': 
+SCHEDULE_BUILDER_URL = 'https://sb.cunyfirst.cuny.edu'
+LOGIN_REDIRECT_URL = 'https://cssa.cunyfirst.cuny.edu/psc/cnycsprd/EMPLOYEE/SA/s/WEBLIB_VSB.TRANSFER_FUNCS.FieldFormula.IScript_RedirectVSBuilder?INSTITUTION=LAG01'
+SSO_SUBMIT_URL = 'https://ssologin.cuny.edu/oam/server/auth_cred_submit'
+# An expired session is redirected back to the SSO login pages.
+SSO_LOGIN_PREFIX = 'https://ssologin.cuny.edu/'
+
+headers = {'User-Agent':
     'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
     'Chrome/114.0.0.0 Safari/537.36'
 }
-payload = {
-    'usernameH': f'{os.getenv("USERNAMEH")}',
-    'username': f'{os.getenv("USER")}',
-    'password': f'{os.getenv("PASSWORD")}',
-    'submit': ''
-}
 
-async def send_request(action, term, prev_class_id, new_class_id):
-    try:
-        async with httpx.AsyncClient(headers=headers, verify=context, follow_redirects=True) as client:
-            await client.get('https://cssa.cunyfirst.cuny.edu/psc/cnycsprd/EMPLOYEE/SA/s/WEBLIB_VSB.TRANSFER_FUNCS.FieldFormula.IScript_RedirectVSBuilder?INSTITUTION=LAG01')
-            await client.post('https://ssologin.cuny.edu/oam/server/auth_cred_submit', data=payload)
-            return await perform_action(client, action, term, prev_class_id, new_class_id)
-    except Exception as e:
-        logger.error(f'An error occurred while trying to send a request to Schedule Builder: {e}')
-        return None
 
+class LoginError(Exception):
+    pass
+
+
+class SessionExpired(Exception):
+    pass
 
-async def perform_action(client, action, term, prev_class_id, new_class_id):
+
+def credentials_payload():
+    return {
+        'usernameH': f'{os.getenv("USERNAMEH")}',
+        'username': f'{os.getenv("USER")}',
+        'password': f'{os.getenv("PASSWORD")}',
+        'submit': ''
+    }
+
+
+def action_states(action, prev_class_id, new_class_id):
     action = action.lower()
     if action == 'drop':
-        a = 'E'
-        b = 'G'
-    elif action == 'swap':
+        return 'E', 'G'
+    if action == 'swap':
         if prev_class_id == new_class_id:
             raise ValueError('You are trying to do a swap when the classes are the same!')
-        a = b = 'E'
-    elif action == 'add':
-        a = 'T'
-        b = 'E'
-    else:
-        raise ValueError(f'Invalid action parameter in prepare_action_params(). Expected "drop", "add", or "swap", but got {action}.')
-    
-    try:
-        async with aiosqlite.connect('classes.db') as conn:
-            term_info = await access_db.get_term_info(conn, term)
+        return 'E', 'E'
+    if action == 'add':
+        return 'T', 'E'
+    raise ValueError(f'Invalid action parameter in action_states(). Expected "drop", "add", or "swap", but got {action}.')
+
+
+def action_message(text):
+    message = BeautifulSoup(text, 'html.parser').find('div', {'class': 'actionInfoMessage'})
+    return message.text if message else None
+
+
+def timestamp():
+    return f'{int(time.time() * 1000)}'
+
+
+class ScheduleBuilderClient:
+    """One logged in Schedule Builder session that is reused for every action.
+
+    It logs in on first use and again only once the session has expired, which shows up as
+    a redirect to the SSO login page or a 401/403, or once it has sat idle for idle_timeout seconds."""
+
+    def __init__(self, db=None, database='classes.db', institution='QNS01', base_url=SCHEDULE_BUILDER_URL,
+                 login_url=LOGIN_REDIRECT_URL, sso_url=SSO_SUBMIT_URL, sso_prefix=SSO_LOGIN_PREFIX, verify=context,
+                 credentials=None, idle_timeout=1200, timeout=15, registry=None):
+        self.db = db or db_manager.DatabaseManager(database)
+        self.owns_db = db is None
+        self.institution = institution
+        self.base_url = base_url
+        self.login_url = login_url
+        self.sso_url = sso_url
+        self.sso_prefix = sso_prefix
+        self.verify = verify
+        self.credentials = credentials
+        self.idle_timeout = idle_timeout
+        self.timeout = httpx.Timeout(timeout)
+
+        self.client = None
+        self.logged_in = False
+        self.last_used = 0
+        self.login_lock = asyncio.Lock()
+        # Actions change the same enrollment, so they are sent one at a time even when several callers share the client.
+        self.action_lock = asyncio.Lock()
+        self.terms = {}
+
+        registry = registry or metrics.MetricsRegistry()
+        self.logins = registry.counter('schedule_builder_logins_total', 'Schedule Builder logins, by reason.', ('reason',))
+        self.action_seconds = registry.histogram('schedule_builder_action_seconds', 'Time taken by Schedule Builder actions.', ('action',))
+        self.actions = registry.counter('schedule_builder_actions_total', 'Schedule Builder actions by outcome.', ('result',))
+
+    def new_client(self):
+        return httpx.AsyncClient(headers=headers, verify=self.verify, follow_redirects=True, timeout=self.timeout)
+
+    def is_expired(self, response):
+        return str(response.url).startswith(self.sso_prefix) or response.status_code in (401, 403)
+
+    async def login(self, reason='start'):
+        async with self.login_lock:
+            if self.logged_in and time.monotonic() - self.last_used < self.idle_timeout:
+                return
+            if self.client:
+                await self.client.aclose()
+            self.client = self.new_client()
+            self.logged_in = False
+            await self.client.get(self.login_url)
+            response = await self.client.post(self.sso_url, data=self.credentials or credentials_payload())
+            response.raise_for_status()
+            if self.is_expired(response):
+                raise LoginError('Schedule Builder sent the login page back. Check USERNAMEH, USER and PASSWORD.')
+            self.logged_in = True
+            self.last_used = time.monotonic()
+            self.logins.inc(reason=reason)
+            logger.info(f'Logged in to Schedule Builder ({reason}).')
+
+    async def ensure_logged_in(self):
+        if not self.logged_in:
+            await self.login()
+        elif time.monotonic() - self.last_used >= self.idle_timeout:
+            await self.login('idle')
+
+    async def keep_alive(self, margin=60):
+        """Logs in again ahead of the idle timeout, so an action that has to be fast never waits on a login."""
+        async with self.action_lock:
+            if not self.logged_in or time.monotonic() - self.last_used >= self.idle_timeout - margin:
+                self.logged_in = False
+                await self.login('keepalive')
+
+    async def get_term(self, term):
+        """Returns (hidden_value, term_id) for term, reading term_info only the first time."""
+        if term not in self.terms:
+            await self.db.open()
+            async with self.db.reader() as conn:
+                term_info = await access_db.get_term_info(conn, term)
             if not term_info:
                 raise ValueError(f'No row found in term_info for term: {term}')
-    except Exception as e:
-        logger.error(f'An error occured when trying to access the DB: {e}')
-        return None
-    
-    _, hidden_value, term_ID = term_info
-    prev_class_string = f'QNS01--{hidden_value}_{prev_class_id}--'
-    new_class_string = f'QNS01--{hidden_value}_{new_class_id}--'
-    params = {
-        'statea': a,
-        'keya': prev_class_string,
-        'stateb': b,
-        'keyb': new_class_string,
-        '_': f'{int(time.time() * 1000)}'
-    }
-    await client.get(f'https://sb.cunyfirst.cuny.edu/api/enroll-options', params=params)
-
-    params = {
-        'conditionalAddDrop': '0', # What triggers this to be a value other than 0?
-        'statea0': a,
-        'keya0': prev_class_string,
-        'vaa0': '99zz', # Eventually change this to get the proper validation keys.
-        'vab0': '99zz', # Although it will still correctly perform the action.
-        'stateb0': b,
-        'keyb0': new_class_string,
-        'schoolTermId': term_ID,
-        '_': f'{int(time.time() * 1000)}'
-    }
-    response = await client.get(f'https://sb.cunyfirst.cuny.edu/api/perform-action', params=params)
-    soup = BeautifulSoup(response.text, 'html.parser')
-    message = soup.find('div', {'class': 'actionInfoMessage'}).text
-    return message
+            _, hidden_value, term_id = term_info
+            self.terms[term] = (hidden_value, term_id)
+        return self.terms[term]
+
+    async def class_key(self, term, class_id, institution=None):
+        hidden_value, _ = await self.get_term(term)
+        return f'{institution or self.institution}--{hidden_value}_{class_id}--'
+
+    async def prepare(self, action, term, prev_class_id, new_class_id, institution=None):
+        """Builds the enroll-options and perform-action parameters for an action ahead of time.
+
+        institution is the college both classes belong to, the client's own by default."""
+        a, b = action_states(action, prev_class_id, new_class_id)
+        _, term_id = await self.get_term(term)
+        prev_class_string = await self.class_key(term, prev_class_id, institution)
+        new_class_string = await self.class_key(term, new_class_id, institution)
+        options = {'statea': a, 'keya': prev_class_string, 'stateb': b, 'keyb': new_class_string}
+        perform = {
+            'conditionalAddDrop': '0', # What triggers this to be a value other than 0?
+            'statea0': a,
+            'keya0': prev_class_string,
+            'vaa0': '99zz', # Eventually change this to get the proper validation keys.
+            'vab0': '99zz', # Although it will still correctly perform the action.
+            'stateb0': b,
+            'keyb0': new_class_string,
+            'schoolTermId': term_id
+        }
+        return options, perform
+
+    async def request(self, path, params):
+        response = await self.client.get(f'{self.base_url}{path}', params={**params, '_': timestamp()})
+        if self.is_expired(response):
+            raise SessionExpired(f'The Schedule Builder session expired during {path}.')
+        response.raise_for_status()
+        self.last_used = time.monotonic()
+        return response
+
+    async def submit(self, options, perform):
+        await self.request('/api/enroll-options', options)
+        response = await self.request('/api/perform-action', perform)
+        return action_message(response.text)
+
+    async def run_prepared(self, action, options, perform):
+        """Sends an action prepared by prepare(), logging in again once if the session has expired."""
+        async with self.action_lock:
+            with self.action_seconds.time(action=action):
+                await self.ensure_logged_in()
+                try:
+                    message = await self.submit(options, perform)
+                except SessionExpired as e:
+                    logger.info(f'{e} Logging in again.')
+                    self.logged_in = False
+                    await self.login('expired')
+                    message = await self.submit(options, perform)
+        self.actions.inc(result='done' if message else 'no_message')
+        return message
+
+    async def perform_action(self, action, term, prev_class_id, new_class_id, institution=None):
+        try:
+            options, perform = await self.prepare(action, term, prev_class_id, new_class_id, institution)
+            return await self.run_prepared(action.lower(), options, perform)
+        except Exception as e:
+            self.actions.inc(result='error')
+            logger.error(f'An error occurred while trying to {action} through Schedule Builder: {e}')
+            return None
+
+    async def perform_actions(self, actions):
+        """Runs a batch of (action, term, prev_class_id, new_class_id[, institution]) over the one session, in order.
+
+        Returns the message for each action, or None for an action that failed; a failure does not stop the rest."""
+        return [await self.perform_action(*action) for action in actions]
+
+    async def close(self):
+        if self.client:
+            await self.client.aclose()
+            self.client = None
+        self.logged_in = False
+        if self.owns_db:
+            await self.db.close()
+
+
+async def send_request(action, term, prev_class_id, new_class_id):
+    client = ScheduleBuilderClient()
+    try:
+        return await client.perform_action(action, term, prev_class_id, new_class_id)
+    finally:
+        await client.close()
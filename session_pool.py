@@ -0,0 +1,349 @@
+import time
+import asyncio
+from contextlib import asynccontextmanager
+import httpx
+import metrics
+import logger_utility
+
+logger = logger_utility.setup_logger(__name__, 'session_pool.log')
+
+GLOBAL_SEARCH_URL = 'https://globalsearch.cuny.edu/CFGlobalSearchTool/CFSearchToolController'
+
+try:
+    import h2 # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class SoftFailure(Exception):
+    pass
+
+
+class GlobalSearchSession:
+    def __init__(self, slot, client, max_requests):
+        self.slot = slot
+        self.client = client
+        self.semaphore = asyncio.BoundedSemaphore(max_requests)
+        self.created_at = time.monotonic()
+        self.healthy = True
+        self.retiring = False
+        self.consecutive_failures = 0
+        self.ambiguous_streak = 0
+        self.requests = 0
+        self.in_flight = 0
+
+    @property
+    def age(self):
+        return time.monotonic() - self.created_at
+
+
+class SessionPool:
+    def __init__(self, payload, headers, governor, size=3, http2=False, requests_per_session=2, max_failures=3,
+                 max_keepalive_connections=4, keepalive_expiry=30, timeout=15, wait_time=10, url=GLOBAL_SEARCH_URL,
+                 registry=None, max_age=1200, standby=True, soft_failure_attempts=2):
+        if http2 and not HTTP2_AVAILABLE:
+            logger.warning('HTTP/2 was requested but the h2 package is not installed. Falling back to HTTP/1.1.')
+            http2 = False
+        self.url = url
+        self.payload = payload
+        self.headers = headers
+        self.governor = governor
+        self.size = size
+        self.http2 = http2
+        self.requests_per_session = requests_per_session
+        self.max_failures = max_failures
+        self.limits = httpx.Limits(
+            max_connections=requests_per_session,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.timeout = httpx.Timeout(timeout)
+        self.wait_time = wait_time
+        # Sessions are rotated after max_age seconds, before Global Search gets a chance to expire them.
+        self.max_age = max_age
+        self.soft_failure_attempts = soft_failure_attempts
+        self.use_standby = standby
+        self.standby = None
+        self.standby_needed = asyncio.Event()
+        self.standby_task = None
+
+        self.sessions = [None] * size
+        self.replacing = {}
+        self.available = asyncio.Event()
+        self.next_slot = 0
+        self.recreations = 0
+
+        registry = registry or metrics.MetricsRegistry()
+        self.request_seconds = registry.histogram('globalsearch_request_seconds', 'Time taken by Global Search requests.', ('method',))
+        self.rate_wait_seconds = registry.histogram(
+            'globalsearch_rate_wait_seconds', 'Time spent waiting for the rate governor before a request.', buckets=metrics.PARSE_BUCKETS + (5, 10, 30)
+        )
+        self.responses = registry.counter('globalsearch_responses_total', 'Global Search responses by HTTP status.', ('status',))
+        self.request_errors = registry.counter('globalsearch_request_errors_total', 'Global Search requests that raised, by error type.', ('type',))
+        self.session_recreations = registry.counter('globalsearch_session_recreations_total', 'Sessions replaced, for any reason.')
+        self.session_rotations = registry.counter('globalsearch_session_rotations_total', 'Sessions retired, by reason.', ('reason',))
+        self.soft_failures = registry.counter(
+            'globalsearch_soft_failures_total', 'Successful responses that were not the expected page, by problem.', ('problem',)
+        )
+        self.standby_swaps = registry.counter('globalsearch_standby_swaps_total', 'Retired sessions replaced at once by the standby.')
+
+    @property
+    def active(self):
+        return any(session and session.healthy for session in self.sessions)
+
+    async def create_client(self):
+        client = httpx.AsyncClient(headers=self.headers, http2=self.http2, limits=self.limits, timeout=self.timeout)
+        try:
+            response = await self.send(client, 'POST', data=self.payload)
+            response.raise_for_status()
+            return client
+        except Exception:
+            await client.aclose()
+            raise
+
+    async def create_session(self, slot):
+        while True:
+            try:
+                return GlobalSearchSession(slot, await self.create_client(), self.requests_per_session)
+            except Exception as e:
+                logger.error(f'An error occured while creating session {slot}: {e}\nTrying again in {self.wait_time} seconds.')
+                await asyncio.sleep(self.wait_time)
+
+    async def install(self, slot, session):
+        old_session = self.sessions[slot]
+        session.slot = slot
+        self.sessions[slot] = session
+        self.available.set()
+        if old_session:
+            self.recreations += 1
+            self.session_recreations.inc()
+            # Requests still running on the old client finish before it is closed.
+            while old_session.in_flight:
+                await asyncio.sleep(0.1)
+            await old_session.client.aclose()
+        logger.info(f'Session {slot} is ready.')
+
+    async def fill_slot(self, slot):
+        await self.install(slot, await self.create_session(slot))
+
+    async def keep_standby(self):
+        # One logged-in session is kept aside so a retired session can be swapped out without waiting on Global Search.
+        while True:
+            try:
+                if self.standby is None or self.standby.age >= self.max_age:
+                    new_standby = await self.create_session('standby')
+                    # replace() may have taken the old standby while the new one was logging in.
+                    old_standby, self.standby = self.standby, new_standby
+                    logger.info('Standby session is ready.')
+                    if old_standby:
+                        await old_standby.client.aclose()
+                self.standby_needed.clear()
+                # Read again, since replace() can take the standby during the close above.
+                timeout = max(self.max_age - self.standby.age, 1) if self.standby else 1
+                await asyncio.wait_for(self.standby_needed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f'An error occured while keeping the standby session ready: {e}\nTrying again in {self.wait_time} seconds.')
+                await asyncio.sleep(self.wait_time)
+
+    def snapshot(self):
+        """Returns the cookies and age of each usable session, so another process can pick them up."""
+        return [
+            {'cookies': [[cookie.name, cookie.value, cookie.domain, cookie.path] for cookie in session.client.cookies.jar],
+             'age': session.age}
+            for session in self.sessions if session and session.healthy and not session.retiring
+        ]
+
+    def restore_session(self, slot, state):
+        client = httpx.AsyncClient(headers=self.headers, http2=self.http2, limits=self.limits, timeout=self.timeout)
+        for name, value, domain, path in state['cookies']:
+            client.cookies.set(name, value, domain, path)
+        session = GlobalSearchSession(slot, client, self.requests_per_session)
+        session.created_at -= state['age']
+        return session
+
+    async def start(self, restored=()):
+        """Fills the pool, starting with any restored sessions from snapshot().
+
+        A restored session Global Search has already expired turns up as a soft failure and is replaced as usual."""
+        restored = [state for state in restored if state['age'] < self.max_age][:self.size]
+        for slot, state in enumerate(restored):
+            self.sessions[slot] = self.restore_session(slot, state)
+        if restored:
+            self.available.set()
+            logger.info(f'Restored {len(restored)} sessions.')
+        tasks = {slot: asyncio.create_task(self.fill_slot(slot)) for slot in range(len(restored), self.size)}
+        # Only wait for the first session; the rest join the pool as they come up.
+        if tasks and not restored:
+            await asyncio.wait(tasks.values(), return_when=asyncio.FIRST_COMPLETED)
+        for slot, task in tasks.items():
+            if not task.done():
+                self.replacing[slot] = task
+        if self.use_standby:
+            self.standby_task = asyncio.create_task(self.keep_standby())
+
+    def replace(self, slot, reason='failures'):
+        if slot in self.replacing and not self.replacing[slot].done():
+            return
+        self.session_rotations.inc(reason=reason)
+        if self.standby and self.standby.age < self.max_age:
+            standby, self.standby = self.standby, None
+            self.standby_needed.set()
+            self.standby_swaps.inc()
+            self.replacing[slot] = asyncio.create_task(self.install(slot, standby))
+        else:
+            self.replacing[slot] = asyncio.create_task(self.fill_slot(slot))
+
+    def retire_if_old(self, session):
+        # The old session keeps serving until its replacement is installed, so rotating by age never leaves a gap.
+        if not session.retiring and session.age >= self.max_age:
+            session.retiring = True
+            logger.info(f'Session {session.slot} is {session.age:.0f} seconds old. Rotating it.')
+            self.replace(session.slot, reason='age')
+
+    def pick(self):
+        # Round robin over healthy sessions, skipping any whose request slots are all taken.
+        candidates = []
+        for offset in range(self.size):
+            slot = (self.next_slot + offset) % self.size
+            session = self.sessions[slot]
+            if session and session.healthy:
+                candidates.append(session)
+                if session.in_flight < self.requests_per_session:
+                    self.next_slot = slot + 1
+                    return session
+        if candidates:
+            return min(candidates, key=lambda session: session.in_flight)
+        return None
+
+    async def acquire(self):
+        while True:
+            session = self.pick()
+            if session:
+                self.retire_if_old(session)
+                return session
+            self.available.clear()
+            await self.available.wait()
+
+    def report_success(self, session):
+        session.consecutive_failures = 0
+
+    def report_failure(self, session, error):
+        session.consecutive_failures += 1
+        if session.healthy and session.consecutive_failures >= self.max_failures:
+            logger.warning(f'Session {session.slot} failed {session.consecutive_failures} times in a row ({error}). Replacing it.')
+            session.healthy = False
+            self.replace(session.slot)
+
+    @asynccontextmanager
+    async def session(self):
+        session = await self.acquire()
+        session.in_flight += 1
+        try:
+            async with session.semaphore:
+                session.requests += 1
+                try:
+                    yield session
+                except Exception as e:
+                    self.report_failure(session, e)
+                    raise
+                self.report_success(session)
+        finally:
+            session.in_flight -= 1
+
+    async def send(self, client, method, **kwargs):
+        with self.rate_wait_seconds.time():
+            await self.governor.acquire()
+        try:
+            with self.request_seconds.time(method=method):
+                response = await client.request(method, self.url, **kwargs)
+        except Exception as e:
+            self.request_errors.inc(type=type(e).__name__)
+            if isinstance(e, httpx.TimeoutException):
+                self.governor.record_failure('a timeout')
+            raise
+        self.responses.inc(status=response.status_code)
+        self.governor.record_response(response)
+        return response
+
+    async def get(self, params, validate=None, ambiguous=None):
+        """GETs from Global Search. validate gets the response body and returns a problem, if any, with it.
+
+        A 200 response with a problem counts against the session like an error and is retried once on another session.
+        ambiguous flags pages that may be a lapsed session or the real answer. Those are fetched again on another
+        session and only held against the first one if the second gets a different page; otherwise they are returned."""
+        suspects = []
+        for attempt in range(1, self.soft_failure_attempts + 1):
+            try:
+                async with self.session() as session:
+                    response = await self.send(session.client, 'GET', params=params)
+                    response.raise_for_status()
+                    problem = validate(response.content) if validate else None
+                    if problem:
+                        self.soft_failures.inc(problem=problem)
+                        raise SoftFailure(f'Session {session.slot} returned {problem}.')
+                    if ambiguous and ambiguous(response.content):
+                        suspects.append(session)
+                        if attempt < self.soft_failure_attempts:
+                            continue
+            except SoftFailure as e:
+                if attempt == self.soft_failure_attempts:
+                    raise
+                logger.warning(f'{e} Retrying on another session.')
+                continue
+            if not ambiguous:
+                return response
+            if ambiguous(response.content):
+                self.record_ambiguous(suspects)
+            else:
+                session.ambiguous_streak = 0
+                for suspect in suspects:
+                    self.soft_failures.inc(problem='an ambiguous page')
+                    self.report_failure(suspect, 'a page another session did not get')
+            return response
+
+    def record_ambiguous(self, sessions):
+        # Every session got the same ambiguous page, which is usually the real answer. But sessions
+        # that get nothing else several times in a row have most likely all lapsed together.
+        for session in sessions:
+            session.ambiguous_streak += 1
+            if session.healthy and session.ambiguous_streak >= self.max_failures:
+                logger.warning(f'Session {session.slot} got {session.ambiguous_streak} ambiguous pages in a row. Replacing it.')
+                self.soft_failures.inc(problem='an ambiguous page')
+                session.healthy = False
+                self.replace(session.slot)
+
+    async def post(self, data, validate=None):
+        """POSTs to Global Search. validate works as in get(): a response with a problem counts
+        against the session and is retried once on another session."""
+        for attempt in range(1, self.soft_failure_attempts + 1):
+            try:
+                async with self.session() as session:
+                    response = await self.send(session.client, 'POST', data=data)
+                    response.raise_for_status()
+                    problem = validate(response.content) if validate else None
+                    if problem:
+                        self.soft_failures.inc(problem=problem)
+                        raise SoftFailure(f'Session {session.slot} returned {problem}.')
+                    return response
+            except SoftFailure as e:
+                if attempt == self.soft_failure_attempts:
+                    raise
+                logger.warning(f'{e} Retrying on another session.')
+
+    async def close(self):
+        if self.standby_task:
+            self.standby_task.cancel()
+        if self.standby:
+            await self.standby.client.aclose()
+            self.standby = None
+        for task in self.replacing.values():
+            task.cancel()
+        for session in self.sessions:
+            if session:
+                await session.client.aclose()
+        self.sessions = [None] * self.size
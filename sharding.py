@@ -0,0 +1,78 @@
+import time
+import bisect
+import socket
+import hashlib
+import access_db
+import logger_utility
+
+logger = logger_utility.setup_logger(__name__, 'sharding.log')
+
+
+def hash_key(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self.nodes = tuple(sorted(nodes))
+        # Each node sits at several points on the ring so that a node joining or leaving
+        # only moves about 1 / len(nodes) of the keys, spread over every other node.
+        points = sorted((hash_key(f'{node}#{replica}'), node) for node in self.nodes for replica in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.owners = [node for _, node in points]
+
+    def owner(self, key):
+        if not self.owners:
+            return None
+        index = bisect.bisect(self.hashes, hash_key(key)) % len(self.hashes)
+        return self.owners[index]
+
+
+class ShardCoordinator:
+    """Splits courses between tracker workers that heartbeat into the shared tracker_workers table.
+
+    A worker's lease lasts lease_ttl seconds from its last heartbeat, so a worker that dies gives up its
+    courses once the lease runs out, and a worker that joins takes its share at everyone's next heartbeat."""
+
+    def __init__(self, db, worker_id, lease_ttl=30, heartbeat_interval=10, replicas=64):
+        self.db = db
+        self.worker_id = worker_id
+        self.host = socket.gethostname()
+        self.lease_ttl = lease_ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.replicas = replicas
+        self.ring = HashRing((worker_id,), replicas)
+        self.last_heartbeat = 0
+
+    @property
+    def workers(self):
+        return self.ring.nodes
+
+    def owns(self, class_id):
+        return self.ring.owner(class_id) == self.worker_id
+
+    def heartbeat_due(self):
+        return time.monotonic() - self.last_heartbeat >= self.heartbeat_interval
+
+    async def heartbeat(self):
+        """Renews this worker's lease and returns whether the set of live workers changed."""
+        self.last_heartbeat = time.monotonic()
+        now = time.time()
+        async with self.db.writer() as conn:
+            if not await access_db.heartbeat_worker(conn, self.worker_id, self.host, now, now - self.lease_ttl):
+                # Keep the last known ring; if the lease has lapsed, the others stop counting on this worker anyway.
+                return False
+            workers = await access_db.fetch_live_workers(conn, now - self.lease_ttl)
+        if self.worker_id not in workers:
+            workers.append(self.worker_id)
+        if tuple(sorted(workers)) == self.ring.nodes:
+            return False
+        logger.info(f'Worker {self.worker_id} now shares courses with {len(workers) - 1} other workers: {sorted(workers)}')
+        self.ring = HashRing(workers, self.replicas)
+        return True
+
+    async def leave(self):
+        async with self.db.writer() as conn:
+            await access_db.remove_worker(conn, self.worker_id)
+        logger.info(f'Worker {self.worker_id} released its lease.')
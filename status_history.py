@@ -0,0 +1,71 @@
+import datetime
+from itertools import groupby
+from operator import itemgetter
+from zoneinfo import ZoneInfo
+
+# Days and hours of day are reported in the colleges' local time.
+TIMEZONE = ZoneInfo('America/New_York')
+
+# Statuses are stored as small integers so each transition row is three integers.
+STATUS_CODES = {'Close': 0, 'Open': 1, 'Wait List': 2}
+STATUS_NAMES = {code: status for status, code in STATUS_CODES.items()}
+UNKNOWN_STATUS = 3
+OPEN = STATUS_CODES['Open']
+
+
+def encode_status(status):
+    return STATUS_CODES.get(status, UNKNOWN_STATUS)
+
+
+def decode_status(code):
+    return STATUS_NAMES.get(code, 'Unknown')
+
+
+def day_of(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, TIMEZONE).date().toordinal()
+
+
+def day_start(day):
+    return int(datetime.datetime.combine(datetime.date.fromordinal(day), datetime.time(), TIMEZONE).timestamp())
+
+
+def add_segment(daily, class_id, start, end, status):
+    while start < end:
+        day = day_of(start)
+        chunk_end = min(end, day_start(day + 1))
+        entry = daily.setdefault((class_id, day), [0, 0])
+        if status == OPEN:
+            entry[0] += chunk_end - start
+        start = chunk_end
+
+
+def roll_up(transitions, first_day, now):
+    """Turns transitions into (class_id, day, open_seconds, flips) and (class_id, hour, flips) rows.
+
+    transitions are (class_id, changed_at, status) sorted by class and time. Each class's last transition
+    before first_day must be included so its status at the start of the window is known. Hours are counted
+    from the epoch, so they stay comparable across daylight saving changes."""
+    window_start = day_start(first_day)
+    daily = {}
+    hourly = {}
+    for class_id, group in groupby(transitions, key=itemgetter(0)):
+        previous = None
+        for _, changed_at, status in group:
+            if previous is not None:
+                add_segment(daily, class_id, max(previous[0], window_start), changed_at, previous[1])
+                # The first transition for a class only records the status it was first seen with.
+                if status != previous[1] and changed_at >= window_start:
+                    daily.setdefault((class_id, day_of(changed_at)), [0, 0])[1] += 1
+                    hour = (class_id, changed_at // 3600)
+                    hourly[hour] = hourly.get(hour, 0) + 1
+            previous = (changed_at, status)
+        if previous is not None:
+            add_segment(daily, class_id, max(previous[0], window_start), now, previous[1])
+
+    daily_rows = [(class_id, day, open_seconds, flips) for (class_id, day), (open_seconds, flips) in daily.items()]
+    hourly_rows = [(class_id, hour, flips) for (class_id, hour), flips in hourly.items()]
+    return daily_rows, hourly_rows
+
+
+def local_hour(hour):
+    return datetime.datetime.fromtimestamp(hour * 3600, TIMEZONE).hour
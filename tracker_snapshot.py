@@ -0,0 +1,49 @@
+import os
+import json
+import time
+import zlib
+import contextlib
+import logger_utility
+
+logger = logger_utility.setup_logger(__name__, 'tracker_snapshot.log')
+
+SNAPSHOT_VERSION = 1
+
+
+def save(path, state):
+    """Writes state as compressed JSON, replacing the previous snapshot only once the new one is complete."""
+    data = zlib.compress(json.dumps({'version': SNAPSHOT_VERSION, 'saved_at': time.time(), 'state': state},
+                                    separators=(',', ':')).encode())
+    temporary_path = f'{path}.tmp'
+    # The snapshot holds live Global Search session cookies, so only the owner may read it. A leftover
+    # temporary file from an interrupted save is removed first, since os.open only sets the mode on creation.
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(temporary_path)
+    with os.fdopen(os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_path, path)
+    return len(data)
+
+
+def load(path, max_age):
+    """Returns (state, age in seconds) from the snapshot at path, or None if there is no usable snapshot."""
+    try:
+        with open(path, 'rb') as f:
+            snapshot = json.loads(zlib.decompress(f.read()))
+        version, saved_at, state = snapshot['version'], snapshot['saved_at'], snapshot['state']
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError, zlib.error) as e:
+        logger.warning(f'Ignoring the unreadable snapshot at {path}: {e}')
+        return None
+
+    age = time.time() - saved_at
+    if version != SNAPSHOT_VERSION:
+        logger.info(f'Ignoring the snapshot at {path} because it is version {version}, not {SNAPSHOT_VERSION}.')
+        return None
+    if not 0 <= age <= max_age:
+        logger.info(f'Ignoring the snapshot at {path} because it is {age:.0f} seconds old.')
+        return None
+    return state, age